@@ -0,0 +1,221 @@
+#
+#  Unofficial Behringer Control Development Kit - batch conversion
+#
+#  Copyright (C) 2010 Willem van Engen <dev-bc2000@willem.engen.nl>
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License along
+#  with this program; if not, write to the Free Software Foundation, Inc.,
+#  51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+
+import os, shlex, getopt, multiprocessing
+
+from bcfw.util import BCFWException, readchunks
+from bcfw.image import BinaryImage
+from bcfw.codec import syx2dump, dump2syx
+from bcfw.osimage import dump2os, os2dump
+from bcfw.convertcache import convert_digest
+
+##############################################################################
+## Batch conversion
+
+#
+# A manifest lists one conversion per line, with the options bcfwconvert
+# takes for it, like
+#   -i test.bin -I os -o test-bcf.syx -O syx -m bcf2000
+# Empty lines and lines starting with # are ignored. Each input is decoded to
+# a memory dump once, after which the outputs are encoded from it in a pool of
+# processes. Outputs found in the conversion cache are not converted again.
+#
+
+# conversions that can be done
+_conversions = [('os', 'dump'), ('dump', 'os'), ('syx', 'dump'), ('syx', 'os'), ('dump', 'syx'), ('os', 'syx')]
+
+def batch_model(name):
+    '''return model id from a name as given to bcfwconvert -m'''
+    if name == "any": return 0x7f
+    if name.lower() == "bcf2000": return 0x14
+    if name.lower() == "bcr2000": return 0x15
+    return int(name, 0)
+
+def batch_parse(lines):
+    '''return list of conversions from the lines of a manifest; each is a
+       dict with the input and output file and format, offset, base address
+       and model id'''
+    conversions = []
+    for n, line in enumerate(lines):
+        if not line.strip() or line.strip().startswith('#'): continue
+        c = {'line': n+1, 'infile': None, 'informat': None, 'outfile': None, 'outformat': None,
+             'offset': None, 'base': None, 'model': 0x7f}
+        try:
+            opts, args = getopt.getopt(shlex.split(line), "i:o:I:O:s:b:m:")
+            if args: raise getopt.GetoptError("unexpected argument %s"%args[0])
+            for o, a in opts:
+                if o == "-i": c['infile'] = a
+                if o == "-o": c['outfile'] = a
+                if o == "-I": c['informat'] = a
+                if o == "-O": c['outformat'] = a
+                if o == "-s": c['offset'] = int(a, 0)
+                if o == "-b": c['base'] = int(a, 0)
+                if o == "-m": c['model'] = batch_model(a)
+        except (getopt.GetoptError, ValueError), e:
+            raise BCFWException("manifest line %d: %s"%(n+1, e))
+        # same defaults as bcfwconvert
+        if c['informat'] == "syx" and not c['outformat']: c['outformat'] = "os"
+        if c['informat'] == "os" and not c['outformat']: c['outformat'] = "syx"
+        if c['outformat'] == "syx" and not c['informat']: c['informat'] = "os"
+        if c['outformat'] == "os" and not c['informat']: c['informat'] = "syx"
+        if c['informat'] == "os" and c['outformat'] == "syx" and c['base'] is None: c['base'] = 0x2000
+        if not c['informat'] and not c['outformat']:
+            raise BCFWException("manifest line %d: need an input or output file format or both"%(n+1))
+        if not c['infile'] or not c['outfile']:
+            raise BCFWException("manifest line %d: need input and output file"%(n+1))
+        if not (c['informat'], c['outformat']) in _conversions:
+            raise BCFWException("manifest line %d: unimplemented conversion: %s to %s"%(n+1, c['informat'], c['outformat']))
+        if c['outformat'] == "syx" and not c['base']:
+            raise BCFWException("manifest line %d: need to specify base address"%(n+1))
+        conversions.append(c)
+    return conversions
+
+def batch_input(c):
+    '''return what identifies the decoded input of a conversion; the offset
+       of a sysex input is applied after decoding'''
+    offset = c['offset']
+    if c['informat'] == 'syx': offset = None
+    return (os.path.realpath(c['infile']), c['informat'], offset)
+
+def batch_decode(c):
+    '''return memory dump of the input of a conversion'''
+    try:
+        f = open(c['infile'], 'rb')
+    except EnvironmentError:
+        raise BCFWException("Unable to open %s." % c['infile'])
+    if c['informat'] == 'syx':
+        data = syx2dump(bytearray().join(readchunks(f)))
+    else:
+        image = BinaryImage(f)
+        data = bytearray(image[c['offset'] or 0:])
+        image.close()
+        if c['informat'] == 'os': data = os2dump(data)
+    f.close()
+    return data
+
+def batch_encode(c, dump):
+    '''return output of a conversion from the memory dump of its input'''
+    if c['outformat'] == 'syx': return dump2syx(dump, c['base'], c['model'])
+    if c['outformat'] == 'os':
+        if c['informat'] == 'syx' and c['offset']: dump = dump[c['offset']:]
+        return dump2os(dump)
+    return dump
+
+def batch_write(filename, data):
+    '''write file atomically, so that it is either complete or not there'''
+    tmpfile = os.path.join(os.path.dirname(filename), '.%s.%d'%(os.path.basename(filename), os.getpid()))
+    try:
+        f = open(tmpfile, 'wb')
+        f.write(data)
+        f.close()
+        os.rename(tmpfile, filename)
+    except EnvironmentError, e:
+        if os.path.exists(tmpfile): os.remove(tmpfile)
+        raise BCFWException("Unable to write %s: %s" % (filename, e.strerror))
+
+# conversions, decoded inputs and cache of the running batch, which the
+# processes of the pool inherit
+_batch = None
+_decoded = None
+_cache = None
+
+def _batch_job(i):
+    '''encode and write output of a conversion; return error message or None'''
+    c = _batch[i]
+    try:
+        data = batch_encode(c, _decoded[batch_input(c)])
+        if _cache and c['key']: _cache.put(c['key'], str(data))
+        batch_write(c['outfile'], data)
+    except BCFWException, e:
+        return str(e).strip()
+    except Exception, e:
+        return 'error: %s' % e
+
+def batch_cached(conversions, cache):
+    '''write the outputs of conversions that are found in the cache; return
+       list of error message, None on success or False when not found, by
+       conversion'''
+    digests = {}
+    found = []
+    for c in conversions:
+        name = os.path.realpath(c['infile'])
+        if not name in digests:
+            try:
+                digests[name] = convert_digest(open(name, 'rb').read())
+            except EnvironmentError:
+                digests[name] = None
+        c['key'] = None
+        data = None
+        if digests[name]:
+            c['key'] = cache.key(digests[name], c['informat'], c['outformat'], c['offset'], c['base'], c['model'])
+            data = cache.get(c['key'])
+        if data is None:
+            found.append(False)
+            continue
+        try:
+            batch_write(c['outfile'], data)
+            found.append(None)
+        except BCFWException, e:
+            found.append(str(e).strip())
+    return found
+
+def batch_run(conversions, jobs=None, force=False, cache=None):
+    '''Decode each input of the conversions once, then encode the outputs in
+    jobs processes (default: one per cpu). Unless force is given, outputs may
+    not exist yet. Outputs are taken from and stored in the cache (see
+    ConvertCache), if given. Returns list of error message (or None on
+    success) by conversion.'''
+    global _batch, _decoded, _cache
+    if not force:
+        for c in conversions:
+            if os.path.exists(c['outfile']): raise BCFWException("Output file %s exists." % c['outfile'])
+    errors = [False]*len(conversions)
+    if cache: errors = batch_cached(conversions, cache)
+    _batch = conversions
+    _decoded = {}
+    _cache = cache
+    failed = {}
+    for i, c in enumerate(conversions):
+        if errors[i] is not False: continue
+        key = batch_input(c)
+        if key in _decoded or key in failed: continue
+        try:
+            _decoded[key] = batch_decode(c)
+        except BCFWException, e:
+            failed[key] = str(e).strip()
+    for i, c in enumerate(conversions):
+        if errors[i] is False: errors[i] = failed.get(batch_input(c), False)
+    todo = [i for i in range(len(conversions)) if errors[i] is False]
+    jobs = min(jobs or multiprocessing.cpu_count(), len(todo))
+    try:
+        if jobs > 1:
+            # the pool is created now, so that it inherits the decoded inputs
+            pool = multiprocessing.Pool(jobs)
+            try:
+                results = pool.map(_batch_job, todo)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            results = map(_batch_job, todo)
+    finally:
+        _batch = _decoded = _cache = None
+    for i, result in zip(todo, results): errors[i] = result
+    return errors
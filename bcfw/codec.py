@@ -0,0 +1,316 @@
+#
+#  Unofficial Behringer Control Development Kit - sysex codec
+#
+#  Copyright (C) 2010 Willem van Engen <dev-bc2000@willem.engen.nl>
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License along
+#  with this program; if not, write to the Free Software Foundation, Inc.,
+#  51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+
+import sys
+
+from bcfw.util import BCFWException, numpy, bytes2long, long2bytes, xorbytes
+
+##############################################################################
+## Sysex handling
+
+# The 7bit/8bit conversion works on whole 8-byte groups at once. With numpy
+# the groups are rows of a reshaped array; without it, the buffer is taken
+# as one big number and the high bits of all groups are moved together with
+# a few shifts and masks.
+
+def _syx_implode_long(data):
+    groups = len(data)/8
+    x = bytes2long(data)
+    # bit k of each 8th byte goes to bit 7 of byte 6-k of the group
+    for k in range(7):
+        mask = bytearray(8)
+        mask[6-k] = 0x80
+        x |= (x << (15+7*k)) & bytes2long(str(mask)*groups)
+    x = long2bytes(x, len(data))
+    out = bytearray(groups*7)
+    for k in range(7): out[k::7] = x[k::8]
+    return out
+
+def _syx_explode_long(data):
+    groups = len(data)/7
+    out = bytearray(groups*8)
+    for k in range(7): out[k::8] = data[k::7]
+    x = bytes2long(out)
+    # bit 7 of byte 6-k of the group goes to bit k of each 8th byte
+    highbits = 0
+    for k in range(7):
+        mask = bytearray(8)
+        mask[7] = 1<<k
+        highbits |= (x >> (15+7*k)) & bytes2long(str(mask)*groups)
+    x &= bytes2long('\x7f\x7f\x7f\x7f\x7f\x7f\x7f\x00'*groups)
+    return long2bytes(x | highbits, len(out))
+
+def _syx_implode_numpy(data):
+    groups = numpy.frombuffer(data, numpy.uint8).reshape(-1, 8)
+    out = groups[:,:7] | (((groups[:,7:] >> _numpy_shifts) & 1) << 7)
+    return bytearray(out.tostring())
+
+def _syx_explode_numpy(data):
+    groups = numpy.frombuffer(data, numpy.uint8).reshape(-1, 7)
+    out = numpy.empty((len(groups), 8), numpy.uint8)
+    out[:,:7] = groups & 0x7f
+    out[:,7] = numpy.bitwise_or.reduce((groups >> 7) << _numpy_shifts, axis=1)
+    return bytearray(out.tostring())
+
+if numpy: _numpy_shifts = numpy.arange(6, -1, -1, dtype=numpy.uint8)
+
+def syx_implode(data):
+    '''convert 7bit data stream to 8bit;
+       each 8th byte contains high bits of preceding 7 inverted'''
+    if len(data) % 8:
+        raise BCFWException('length of sysex blob must be multiple of 8 but is 0x%x'%len(data))
+    data = bytearray(data)
+    if not data: return data
+    if numpy: return _syx_implode_numpy(data)
+    return _syx_implode_long(data)
+
+def syx_explode(data):
+    '''convert 8bit array to 7bit by inserting a byte with the high bits
+    each 7 bytes'''
+    if len(data) % 7:
+        raise BCFWException('length of data to encode to sysex blob must be multiple of 7 but is 0x%x'%len(data))
+    data = bytearray(data)
+    if not data: return data
+    if numpy: return _syx_explode_numpy(data)
+    return _syx_explode_long(data)
+
+_syx_cipher= [ 0x54, 0x5a, 0x27, 0x30, 0x33, 0x42, 0x43, 0x4f, 0x4e, 0x54, 0x52, 0x4f, 0x4c ]
+def syx_decode(data):
+    '''return deciphered data; as it is xor it works both ways'''
+    data = bytearray(data)
+    key = bytearray(_syx_cipher) * (len(data)/len(_syx_cipher)+1)
+    return xorbytes(data, key[:len(data)])
+
+def syx_checksum_update(byte, checksum):
+    '''return updated checksum for this byte'''
+    for i in range(8):
+        if not ((byte>>i)^checksum)&1: checksum ^= 0x19
+        if checksum&1: checksum |= 0x100
+        checksum >>= 1
+    return checksum
+
+def _syx_checksum_build():
+    '''return table of updated checksums indexed by [checksum][byte]'''
+    # the update is affine in both the byte and the checksum, so every entry
+    # is the xor of the results for byte alone, checksum alone and neither
+    zero = syx_checksum_update(0, 0)
+    bytepart = [syx_checksum_update(b, 0) ^ zero for b in range(256)]
+    table = []
+    for checksum in range(256):
+        checksumpart = syx_checksum_update(0, checksum)
+        table.append(bytearray([checksumpart ^ b for b in bytepart]))
+    return table
+
+_syx_checksum_table = _syx_checksum_build()
+
+def syx_checksum_check():
+    '''return list of (checksum, byte) for which the table differs from
+       syx_checksum_update; empty when the table is right for every input'''
+    bad = []
+    for checksum in range(256):
+        for byte in range(256):
+            if _syx_checksum_table[checksum][byte] != syx_checksum_update(byte, checksum):
+                bad.append((checksum, byte))
+    return bad
+
+def syx_checksum(page, checksum=0):
+    '''return checksum of a whole page of bytes'''
+    table = _syx_checksum_table
+    for byte in bytearray(page): checksum = table[checksum][byte]
+    return checksum
+
+# The write cipher only depends on the sector (its initial dmagic), so the
+# keystream of each 4k sector is computed once when it is first needed.
+_syx_write_keys = {}
+
+def _syx_write_key(sector, length):
+    '''return keystream of the write cipher for a sector'''
+    if length <= 0x1000 and sector in _syx_write_keys:
+        return _syx_write_keys[sector][:length]
+    key = bytearray(max(length, 0x1000))
+    dmagic = sector
+    if not dmagic: dmagic = 0x545a
+    for i in range(0,len(key),2):
+        if dmagic & 1: dmagic ^= 0x8005
+        dmagic >>= 1
+        key[i] = dmagic&0xff
+        key[i+1] = (dmagic>>8)&0xff
+    if len(key) == 0x1000: _syx_write_keys[sector] = key
+    return key[:length]
+
+def syx_decode_write(data, dmagic):
+    '''return (de)ciphered data that happens for writing only'''
+    if len(data)%2:
+        raise BCFWException("syx_decode_write: length must be divisible by two")
+    data = bytearray(data)
+    return xorbytes(data, _syx_write_key(dmagic, len(data)))
+
+## Behringer firmware sysex message
+#
+#    | Manu ID  | Dev+Mod | Cmd | Data               |
+# F0 | 00 20 32 | 00 15   |  34 | 00 01 02 03 04 ... |  F7  (hex)
+#  0 |  1  2  3 |  4  5   |   6 | 7..303             | 304  (dec)
+#
+# Data is decoded with 7to8 shuffling and cipher
+# Then the resulting data is interpreted as follows:
+#
+# Address | Checksum | Firmware page
+#  xx xx  |  y       | f0 f1 f2 f3 ...  (hex)
+#   0  1  |  2       | 3..258           (dec)
+#
+# checksum is computed over firmware page (3..258)
+#
+# The address is the page number (address/0x100). In firmware packets (34) it
+# is split in 8-bit halves, as the bootloader reads it: *(r6+8)<<8+*(r6+9) in
+# disassembly/bootloader_bcr.da. Flash dump packets (74) may use 7-bit halves,
+# like the page requests that ask for them, or 8-bit halves; which one the
+# device sends is not known, so both are accepted. They agree below page
+# 0x100, and a dump starting there is told apart by the first packet that
+# continues only with 8-bit halves; a dump starting above it may be shown
+# with another starting address, its contents are the same.
+
+_offs=0
+def syx_parse_packet(idata, lastaddr, command=0x74):
+    '''process a single chunk of firmware packet data, that of a firmware
+       (0x34) or flash dump (0x74) packet as given by command; return the
+       firmware page and its address.'''
+    global _offs # hack
+    if len(idata) != 296:
+        raise BCFWException("wrong length: 0x%x should be 0x%x"%(len(idata),296))
+    odata = syx_decode(syx_implode(idata))
+    if command == 0x34: address = ( (odata[0]<<8) + odata[1] ) * 0x100
+    else:
+        address = ( (odata[0]<<7) + odata[1] ) * 0x100
+        # take 8-bit halves when they fit and 7-bit halves do not
+        address8 = ( (odata[0]<<8) + odata[1] ) * 0x100
+        if odata[1] >= 0x80 or (lastaddr is not None and address8 == lastaddr+0x100): address = address8
+    origsum = odata[2]
+    odata = odata[3:]
+    # make sure address is right
+    if lastaddr and address!=lastaddr+0x100:
+        raise BCFWException("No jump in firmware addresses allowed: 0x%05x->0x%05x"%(lastaddr,address))
+        #sys.stderr.write('New address 0x%05x at offset 0x%06x\n'%(address<<8, _offs))
+    _offs+=0x100
+    # and verify checksum
+    checksum = syx_checksum(odata)
+    if checksum != origsum:
+        raise BCFWException("Checksum error: 0x%x should be 0x%x"%(checksum,odata[2]))
+    return odata, address
+
+def syx_split(chunks):
+    '''yield sysex messages from chunks of data; data in between messages is
+       yielded as well so that the caller can recognise it'''
+    buf = bytearray()
+    for chunk in chunks:
+        buf += chunk
+        pos = 0
+        while pos < len(buf):
+            start = buf.find('\xf0', pos)
+            if start < 0: start = len(buf)
+            if start > pos: yield buf[pos:start]
+            pos = start
+            end = buf.find('\xf7', start)
+            # keep incomplete message for next chunk
+            if start == len(buf) or end < 0: break
+            yield buf[start:end+1]
+            pos = end+1
+        del buf[:pos]
+
+def syx2dump_stream(chunks):
+    '''convert chunks of a sysex file to a memory dump; each 4k sector is
+       yielded as soon as its last packet has been parsed'''
+    sector = bytearray()
+    offset = 0
+    foundnonsysex = False
+    addr = [None, None]
+    command = None
+    for sysex in syx_split(chunks):
+        # need behringer packet, firmware command
+        if sysex[0] == 0xf0 and sysex[1:4] == '\x00\x20\x32' and len(sysex) > 7 and sysex[6] in [0x34, 0x74]:
+            # make sure we have one packet type: firmware image (0x34) or flash dump (0x74)
+            if not command: command = sysex[6]
+            if sysex[6] != command:
+                raise BCFWException('Cannot parse both firmware image and flash dump packets at once')
+            # parse packet
+            data, addr[1] = syx_parse_packet(sysex[7:-1], addr[1], command)
+            sector += data
+            if addr[0] == None:
+                addr[0] = addr[1]
+                sys.stderr.write('Starting address: 0x%05x\n'%(addr[0]))
+        # non-firmware packet, warn once
+        elif not foundnonsysex:
+            if sysex[0] == 0xf0: byte = sysex[-1]
+            else: byte = sysex[0]
+            sys.stderr.write("warning: non-firmware data present in input (mentioning once) 0x%2x\n"%byte)
+            foundnonsysex = True
+        if len(sector) < 0x1000: continue
+        # now do extra deciphering if it is a firmware dump to be written to device
+        if command == 0x34:
+            sector = syx_decode_write(sector, (offset+addr[0])/0x1000)
+        yield sector
+        offset += len(sector)
+        sector = bytearray()
+    # TODO also handle non-4k-aligned
+    if sector and command == 0x34:
+        sector = syx_decode_write(sector, (offset+addr[0])/0x1000)
+    if sector:
+        yield sector
+
+def syx2dump(idata):
+    '''convert a sysex file to a memory dump'''
+    return bytearray().join(syx2dump_stream([idata]))
+
+
+def dump2syx(idata, base, model):
+    '''convert a memory dump to a sysex file'''
+    if base & 0xfff:
+        raise BCFWException("base must be a multiple of 0x1000")
+    odata = bytearray()
+    header = bytearray([0xf0, 0x00, 0x20, 0x32, 0x7f, model, 0x34 ])
+    footer = bytearray([0xf7])
+    if base < 0x2000:
+        raise BCFWException("base address must be 0x2000 or more, or it may brick the device")
+    # make length a multiple of 4k
+    idata = bytearray(idata) + bytearray((0x1000 - (len(idata)%0x1000))%0x1000)
+    # flash in 0x1000=4k byte sectors
+    for page in range(0, len(idata), 0x1000):
+        sector = syx_decode_write(idata[page:page+0x1000], (base+page)/0x1000)
+        # packet size of 0x100
+        for subpage in range(0, 0x1000, 0x100):
+            # construct argument to firmware upload command
+            arg = bytearray(3) + sector[subpage:subpage+0x100]
+            arg[0] = ((base+page+subpage)/0x100) >> 8
+            arg[1] = ((base+page+subpage)/0x100) & 0xff
+            # compute checksum
+            arg[2] = syx_checksum(arg[3:])
+            # and output sysex packet
+            odata += header + syx_explode(syx_decode(arg)) + footer
+    return odata
+
+##############################################################################
+## Self-check
+
+# run as python -m bcfw.codec to check the tables against the bitwise code
+if __name__ == "__main__":
+    bad = syx_checksum_check()
+    for checksum, byte in bad[:10]:
+        sys.stderr.write("checksum table wrong for checksum 0x%02x, byte 0x%02x\n"%(checksum, byte))
+    if bad: sys.exit(1)
+    sys.stderr.write("checksum table ok for all 65536 inputs\n")
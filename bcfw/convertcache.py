@@ -0,0 +1,107 @@
+#
+#  Unofficial Behringer Control Development Kit - conversion cache
+#
+#  Copyright (C) 2010 Willem van Engen <dev-bc2000@willem.engen.nl>
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License along
+#  with this program; if not, write to the Free Software Foundation, Inc.,
+#  51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+
+import os, hashlib, inspect
+
+from bcfw.util import cache_path, xorbytes
+from bcfw.codec import syx2dump_stream, dump2syx
+from bcfw.osimage import os2dump, dump2os
+
+##############################################################################
+## Conversion cache
+
+# functions whose source determines the outputs of conversions
+_converters = [syx2dump_stream, dump2syx, os2dump, dump2os, xorbytes]
+
+class ConvertCache(object):
+    '''Outputs of earlier conversions, kept on disk by a hash of everything
+    that determines them: the input's contents, the formats, offset, base
+    address, model id and the version of the conversion code, by default the
+    digest of its source (see convert_code_digest). When the cache grows
+    beyond maxsize bytes, the outputs that were used longest ago are removed;
+    the modification time of a file is the time it was last used.'''
+
+    def __init__(self, version=None, maxsize=64<<20, cachedir=None):
+        self.version = version or convert_code_digest()
+        self.maxsize = maxsize
+        self.dir = cachedir or cache_path('convert')
+
+    def key(self, digest, informat, outformat, offset, base, model):
+        '''return key of a conversion of input with sha1 digest'''
+        fields = [self.version, digest, informat, outformat, offset, base, model]
+        return hashlib.sha1(' '.join(map(str, fields))).hexdigest()
+
+    def get(self, key):
+        '''return output of a conversion, or None if it is not in the cache'''
+        filename = os.path.join(self.dir, key)
+        try:
+            data = open(filename, 'rb').read()
+            os.utime(filename, None)
+        except EnvironmentError:
+            return None
+        return data
+
+    def put(self, key, data):
+        '''store output of a conversion, if possible'''
+        try:
+            if not os.path.isdir(self.dir): os.makedirs(self.dir)
+            tmpfile = os.path.join(self.dir, '.%s.%d'%(key, os.getpid()))
+            f = open(tmpfile, 'wb')
+            f.write(data)
+            f.close()
+            os.rename(tmpfile, os.path.join(self.dir, key))
+        except EnvironmentError:
+            return
+        self.evict()
+
+    def evict(self):
+        '''remove the outputs used longest ago until the cache fits maxsize'''
+        files = []
+        for name in os.listdir(self.dir):
+            if name.startswith('.'): continue
+            try:
+                st = os.stat(os.path.join(self.dir, name))
+            except OSError:
+                continue
+            files.append((st.st_mtime, st.st_size, name))
+        size = sum([f[1] for f in files])
+        for mtime, fsize, name in sorted(files):
+            if size <= self.maxsize: break
+            try:
+                os.remove(os.path.join(self.dir, name))
+            except OSError:
+                # another process removed it already
+                pass
+            size -= fsize
+
+def convert_code_digest():
+    '''return digest of the source of the modules that do the conversions, so
+       that outputs of another version of them are not used'''
+    files = []
+    for function in _converters:
+        name = inspect.getsourcefile(function) or inspect.getfile(function)
+        if not name in files: files.append(name)
+    h = hashlib.sha1()
+    for name in sorted(files): h.update(open(name, 'rb').read())
+    return h.hexdigest()
+
+def convert_digest(data):
+    '''return digest of conversion input, to be given to ConvertCache.key'''
+    return hashlib.sha1(data).hexdigest()
@@ -0,0 +1,239 @@
+#
+#  Unofficial Behringer Control Development Kit - device emulator
+#
+#  Copyright (C) 2010 Willem van Engen <dev-bc2000@willem.engen.nl>
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License along
+#  with this program; if not, write to the Free Software Foundation, Inc.,
+#  51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+
+import os, pty, tty, select, time, heapq
+
+from bcfw.util import BCFWException
+from bcfw.codec import syx_implode, syx_explode, syx_decode, syx_checksum, syx_decode_write
+from bcfw.midi import SysexReader
+
+##############################################################################
+## Flash memory model
+
+class FlashChip(object):
+    '''SST39SF040 flash memory: 512k in 4k sectors. Erasing a sector sets all
+    its bytes to 0xff, programming can only clear bits. Operations return the
+    time they take on the chip, by default the typical times of the datasheet
+    (18 ms per sector erase, 14 us per byte programmed).'''
+
+    size = 0x80000
+    sectorsize = 0x1000
+
+    def __init__(self, image=None, erasetime=0.018, programtime=14e-6):
+        self.data = bytearray('\xff')*self.size
+        if image: self.data[:len(image)] = image
+        self.erasetime = erasetime
+        self.programtime = programtime
+
+    def erase(self, address):
+        '''erase the sector at address'''
+        address &= ~(self.sectorsize-1)
+        self.data[address:address+self.sectorsize] = '\xff'*self.sectorsize
+        return self.erasetime
+
+    def program(self, address, data):
+        '''program data at address; bits that are cleared already stay so'''
+        for i, b in enumerate(bytearray(data)):
+            self.data[address+i] &= b
+        return len(data)*self.programtime
+
+    def read(self, address, count):
+        '''return contents of a range'''
+        return self.data[address:address+count]
+
+##############################################################################
+## Device emulator
+
+_models = {0x14: 'BCF2000', 0x15: 'BCR2000'}
+
+class Emulator(object):
+    '''Behringer Control device running the bootloader, on a pseudo terminal
+    that can be used like a midi device. It answers identity requests (0x01),
+    writes firmware packets (0x34) to flash a sector at a time and reports the
+    status of each sector (0x35), answers page reads (0x74) and shows text
+    sent to the display address (0xff00), rebooting on "boot".
+
+    Firmware packets are handled as disassembly/bootloader_bcr.da describes:
+    the page number is read as 8-bit halves, packets are collected in a
+    buffer of a single sector, and a packet of another sector shows 'E' on
+    the display and starts over when the sector was not complete. The last
+    packet of a sector writes it when all its packets arrived, and is
+    acknowledged with 6 bits of each half of its page number. Requests are
+    handled one at a time, in the order they arrived.
+
+    Sending and receiving take the time the link needs at rate bytes per
+    second (None for no limit), and each request is answered after latency
+    seconds, on top of the time the flash chip is busy. Sectors given in
+    faults are answered once with that status instead of being written.
+    Page reads are answered with the page number in halves of pagebits bits;
+    which the device uses is not known, 7 like the request or 8 like
+    firmware packets.'''
+
+    def __init__(self, model=0x15, version='1.10', chip=None, rate=None, latency=0.001, faults=None, pagebits=7):
+        if not model in _models: raise BCFWException("unknown model 0x%02x"%model)
+        self.model = model
+        self.version = version
+        self.chip = chip or FlashChip()
+        self.rate = rate
+        self.latency = latency
+        self.faults = dict(faults or {})
+        self.pagebits = pagebits
+        self.display = '    '
+        self.boots = 0
+        self.commands = []          # command of each request received
+        # keep the slave open too, so that it stays usable when the host
+        # closes it
+        self.master, self.slave = pty.openpty()
+        tty.setraw(self.slave)
+        self.path = os.ttyname(self.slave)
+        self.f = os.fdopen(self.master, 'r+b', 0)
+        self.reader = SysexReader(self.f)
+        self.sector = None          # sector being received
+        self.received = 0           # bit mask of its packets received
+        self.buffer = bytearray(0x1000)
+        self.events = []            # heap of (time, sequence, function, args)
+        self.sequence = 0
+        self.busy = 0               # time the device is done with its work
+        self.rxtime = 0             # time the last received byte has arrived
+        self.txtime = 0             # time the next byte may be sent
+        self.out = bytearray()
+        self.running = True
+
+    def close(self):
+        self.running = False
+        self.f.close()
+        os.close(self.slave)
+
+    def schedule(self, t, function, *args):
+        '''call function at time t'''
+        heapq.heappush(self.events, (t, self.sequence, function, args))
+        self.sequence += 1
+
+    def reply(self, t, cmd, arg, device=0x7f):
+        '''send a sysex message at time t'''
+        msg = bytearray([0xf0, 0x00, 0x20, 0x32, device, self.model, cmd]) + arg + bytearray([0xf7])
+        self.schedule(t, self.out.extend, msg)
+
+    def work(self, duration=0):
+        '''return time at which the device is done with work of duration, it
+           does one thing at a time'''
+        self.busy = max(self.busy, time.time()) + duration
+        return self.busy
+
+    def receive(self, data):
+        '''handle data received from the host'''
+        self.reader.feed(data)
+        while self.reader.messages:
+            self.request(self.reader.messages.pop(0))
+
+    def request(self, sysex):
+        '''handle a message once the device is done with earlier ones'''
+        if self.busy > time.time():
+            self.schedule(self.busy, self.request, sysex)
+            return
+        if sysex[1:4] != [0x00, 0x20, 0x32] or len(sysex) < 8: return
+        self.commands.append(sysex[6])
+        if sysex[6] == 0x01: self.identity()
+        elif sysex[6] == 0x34: self.packet(sysex)
+        elif sysex[6] == 0x74: self.page((sysex[7]<<7) + sysex[8])
+
+    def identity(self):
+        self.reply(self.work() + self.latency, 0x02, bytearray('%s %s'%(_models[self.model], self.version)))
+
+    def page(self, page):
+        arg = bytearray([page>>self.pagebits, page&((1<<self.pagebits)-1), 0]) + self.chip.read(page*0x100, 0x100)
+        arg[2] = syx_checksum(arg[3:])
+        self.reply(self.work() + self.latency, 0x34, syx_explode(syx_decode(arg)))
+
+    def packet(self, sysex):
+        try:
+            arg = syx_decode(syx_implode(sysex[7:-1]))
+        except BCFWException:
+            return
+        if len(arg) != 0x103 or syx_checksum(arg[3:]) != arg[2]: return
+        page = (arg[0]<<8) + arg[1]
+        if page == 0xff00:
+            self.display = str(arg[3:7])
+            if self.display == 'boot': self.boot()
+            return
+        if page >= 0x800: return
+        # a packet of another sector abandons the one being received
+        if page>>4 != self.sector:
+            if self.sector is not None and self.received: self.display = 'E' + self.display[1:]
+            self.sector = page>>4
+            self.received = 0
+        self.received |= 1 << (page & 0xf)
+        self.buffer[(page & 0xf)*0x100:(page & 0xf)*0x100+0x100] = arg[3:]
+        if page & 0xf != 0xf: return
+        # the last packet of a sector has arrived, write it when complete
+        address = self.sector*0x1000
+        duration = 0
+        if self.received != 0xffff: status = 1
+        elif address in self.faults: status = self.faults.pop(address)
+        else:
+            duration += self.chip.erase(address)
+            duration += self.chip.program(address, syx_decode_write(self.buffer, self.sector))
+            status = 0
+        self.reply(self.work(duration) + self.latency, 0x35, bytearray([(page>>7)&0x3f, page&0x3f, status]), 0x00)
+
+    def boot(self):
+        '''restart, which forgets what was being received'''
+        self.boots += 1
+        self.sector = None
+        self.received = 0
+
+    def serve(self, duration=None):
+        '''handle the link until closed or until duration seconds passed'''
+        end = duration is not None and time.time() + duration or None
+        while self.running and (end is None or time.time() < end):
+            now = time.time()
+            while self.events and self.events[0][0] <= now:
+                t, n, function, args = heapq.heappop(self.events)
+                function(*args)
+            # wait for input, the next event, or until output may be sent
+            timeout = 0.1
+            if self.events: timeout = min(timeout, self.events[0][0] - now)
+            if self.out: timeout = min(timeout, self.txtime - now)
+            if end is not None: timeout = min(timeout, end - now)
+            w = []
+            if self.out and self.txtime <= now: w = [self.master]
+            try:
+                r, w, x = select.select([self.master], w, [], max(timeout, 0))
+            except (select.error, ValueError):
+                return
+            if r:
+                try:
+                    data = os.read(self.master, 0x1000)
+                except OSError:
+                    return
+                # it has arrived when the link could have carried it
+                self.rxtime = max(self.rxtime, now)
+                if self.rate: self.rxtime += len(data)/float(self.rate)
+                self.schedule(self.rxtime, self.receive, data)
+            if w:
+                count = len(self.out)
+                if self.rate: count = min(count, max(int(self.rate*0.01), 1))
+                try:
+                    count = os.write(self.master, str(self.out[:count]))
+                except OSError:
+                    return
+                del self.out[:count]
+                self.txtime = max(self.txtime, now)
+                if self.rate: self.txtime += count/float(self.rate)
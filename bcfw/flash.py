@@ -0,0 +1,441 @@
+#
+#  Unofficial Behringer Control Development Kit - flash upload and retrieval
+#
+#  Copyright (C) 2010 Willem van Engen <dev-bc2000@willem.engen.nl>
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License along
+#  with this program; if not, write to the Free Software Foundation, Inc.,
+#  51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+
+import sys, time, threading, hashlib
+
+from bcfw.util import BCFWException, str2array
+from bcfw.codec import syx_implode, syx_explode, syx_decode, syx_checksum, syx_split, syx_decode_write, syx_parse_packet
+from bcfw.midi import MidiPort, midi_check_sysex, midi_linkrates
+
+##############################################################################
+## Flash upload functions
+
+# initial, minimum and maximum time to wait for a reply to a page request and
+# for acknowledgement of a written sector; the device's round trip times are
+# measured to adapt these to the link and the device
+_blobtimeout = (0.2, 0.02, 2.0)
+_sectortimeout = (4.0, 0.5, 10.0)
+
+def flash_sectors(data):
+    '''split sysex firmware data into the messages of each 4k sector; return
+       list of (messages, acknowledged, payload, address) with the messages
+       joined to send, the packet contents as they are to be written and the
+       sector's address (None for trailing messages without a full sector)'''
+    sectors = []
+    messages = []
+    payload = bytearray()
+    nonsysexwarned = False
+    for sysex in syx_split([data]):
+        if sysex[0] != 0xf0:
+            if not nonsysexwarned:
+                sys.stderr.write('warning: found non-sysex data (mentioning only once)\n')
+                nonsysexwarned = True
+            continue
+        messages.append(sysex)
+        # the device acknowledges the last packet of each 4k sector
+        if sysex[1:4] != '\x00\x20\x32' or len(sysex) < 16 or sysex[6] != 0x34: continue
+        arg = syx_decode(syx_implode(sysex[7:-1]))
+        payload += arg[3:]
+        if arg[1] % 0x10 == 0x0f:
+            address = ((arg[0]<<8) + arg[1])*0x100 - 0xf00
+            sectors.append((str(bytearray().join(messages)), True, payload, address))
+            messages = []
+            payload = bytearray()
+    if messages:
+        sectors.append((str(bytearray().join(messages)), False, payload, None))
+    return sectors
+
+def flash_changed(port, sectors, current=None, window=4, log=None, cache=None):
+    '''return the sectors (as returned by flash_sectors) whose contents differ
+    from what is in flash now. The flash contents are read back from the
+    device unless current is given as (address, data), or the cache knows
+    them and passes a sample check. The first sector of the os image at
+    0x2000 is always included, it has the size and checksum.'''
+    addresses = [s[3] for s in sectors if s[3] is not None]
+    if not addresses: return sectors
+    if current is None:
+        start = min(addresses)
+        count = max(addresses)+0x1000-start
+        data = cache and cache.get(start, count)
+        if data is None or not cache.sample(port):
+            data = flash_read(port, start, count, window, log=log, cache=cache)
+        current = (start, data)
+    start, data = current
+    changed = []
+    for s in sectors:
+        if s[3] is None or s[3] == 0x2000 or s[3] < start:
+            changed.append(s)
+        elif data[s[3]-start:s[3]-start+0x1000] != syx_decode_write(s[2], s[3]/0x1000):
+            changed.append(s)
+    return changed
+
+def flash_resume(sectors, journal):
+    '''return the sectors (as returned by flash_sectors) that were not
+       completed according to the journal of an interrupted upload'''
+    return [s for s in sectors if s[3] is None or not journal.get(s[3], syx_decode_write(s[2], s[3]/0x1000))]
+
+def flash_ack_matches(sysex, address):
+    '''return whether an acknowledgement (0x35) is for the sector at address.
+       The device only sends 6 bits of each half of the page number of the
+       sector's last packet, (page>>7)&0x3f and page&0x3f, so the address
+       cannot be told from it; it can only be compared.'''
+    page = address/0x100 + 0xf
+    return sysex[7]&0x3f == (page>>7)&0x3f and sysex[8]&0x3f == page&0x3f
+
+def flash_upload_sectors(port, sectors, window=2, log=None, cache=None, journal=None, retries=3):
+    '''Upload sectors as returned by flash_sectors to the device. Up to
+    window sectors are sent ahead while waiting for acknowledgement of the
+    first one; on errors it falls back to waiting for each sector and sends
+    failed sectors again, sectors that are not acknowledged up to retries
+    times. Returns list of (address, sector index) of the sectors the device
+    reported as written, which are also recorded in the cache and journal if
+    given.'''
+    log = log or sys.stderr.write
+    rtt = port.estimator(0x34, *_sectortimeout)
+    starttime, sentbefore = time.time(), port.sent
+    queue = range(len(sectors))     # sectors to send
+    pending = []                    # sectors sent but not acknowledged yet
+    sent = {}                       # time each sector was sent
+    tries = dict.fromkeys(queue, 0)
+    written = []
+    while queue or pending:
+        # keep the window filled
+        while queue and len(pending) < window:
+            i = queue.pop(0)
+            if cache and sectors[i][3] is not None: cache.invalidate(sectors[i][3])
+            sendtime = time.time()
+            port.send_sysex(sectors[i][0], time.time()+_sectortimeout[2])
+            sent[i] = time.time()
+            if port.stats: port.stats.sample('sector send', sent[i]-sendtime)
+            tries[i] += 1
+            if sectors[i][1]: pending.append(i)
+        if not pending: continue
+        # and parse response, if any; handle loopback too
+        deadline = sent[pending[0]] + rtt.timeout
+        sysex = port.recv_sysex(deadline)
+        while midi_check_sysex(sysex, [0x34, 0x35], False) == 0x34:
+            sysex = port.recv_sysex(deadline)
+        if not sysex:
+            # acknowledgement lost or sector not received; send it again
+            rtt.backoff()
+            for i in pending:
+                if tries[i] > retries:
+                    raise BCFWException("no acknowledgement from device for sector 0x%06x"%sectors[i][3])
+            if port.stats: port.stats.count('sector retries', len(pending))
+            if window > 1: log('\nwarning: no response, waiting for each sector from now on\n')
+            else: log('\nwarning: no response, sending sector again\n')
+            while port.recv_sysex(time.time()+rtt.timeout): pass
+            queue = pending + queue
+            pending = []
+            window = 1
+            continue
+        # parse response packet; the device handles sectors in order
+        midi_check_sysex(sysex, [0x35])
+        address = sectors[pending[0]][3]
+        if not flash_ack_matches(sysex, address):
+            log('\nwarning: ignoring acknowledgement of another sector than 0x%06x\n'%address)
+            continue
+        i = pending.pop(0)
+        if tries[i] == 1: rtt.sample(time.time() - sent[i])
+        if port.stats: port.stats.sample('sector acknowledgement', time.time()-sent[i])
+        status = 'ok\r'
+        if sysex[9] == 0:
+            written.append((address, i))
+            if cache or journal:
+                data = syx_decode_write(sectors[i][2], address/0x1000)
+                if cache: cache.update(address, data)
+                if journal: journal.add(address, data)
+        if sysex[9] == 1: status = 'sector incomplete\n'
+        if sysex[9] == 2: status = 'erase failure\n'
+        if sysex[9] == 3: status = 'write failure\n'
+        log('0x%06x-0x%06x: %s'%(address,address+0x1000,status))
+        if sysex[9] != 0 and window > 1:
+            log('warning: retrying, waiting for each sector from now on\n')
+            if port.stats: port.stats.count('sector retries')
+            queue.insert(0, i)
+            window = 1
+    elapsed = time.time() - starttime
+    if port.stats: port.stats.add('upload', elapsed, port.sent-sentbefore)
+    log('\nwrote %d sectors in %.1f s (wire %s)\n'%(len(written), elapsed, port.throughput(port.sent-sentbefore, elapsed)))
+    return written
+
+def flash_upload(port, data, window=2, log=None, cache=None, journal=None):
+    '''Upload sysex firmware data to the device; see flash_upload_sectors'''
+    return flash_upload_sectors(port, flash_sectors(data), window, log, cache, journal)
+
+def flash_unwritten(sectors, written):
+    '''return addresses of the sectors that flash_upload_sectors did not write'''
+    done = [i for address, i in written]
+    return [s[3] for i, s in enumerate(sectors) if s[1] and not i in done]
+
+def flash_verify(port, sectors, written, window=4, log=None, cache=None):
+    '''Read back written sectors (as returned by flash_upload_sectors) and
+    return list of (address, sector index) of the sectors whose digest differs
+    from that of what was sent. Adjacent sectors are read back at once.'''
+    log = log or sys.stderr.write
+    starttime = time.time()
+    bad = []
+    todo = sorted(written)
+    while todo:
+        # find run of adjacent sectors
+        n = 1
+        while n < len(todo) and todo[n][0] == todo[0][0] + n*0x1000: n += 1
+        run, todo = todo[:n], todo[n:]
+        data = flash_read(port, run[0][0], n*0x1000, window, log=lambda msg: None, cache=cache)
+        for k, (address, i) in enumerate(run):
+            expected = syx_decode_write(sectors[i][2], address/0x1000)
+            got = buffer(data, k*0x1000, len(expected))
+            if hashlib.sha1(got).digest() != hashlib.sha1(expected).digest():
+                bad.append((address, i))
+    log('verified %d sectors in %.1f s\n'%(len(written), time.time()-starttime))
+    return bad
+
+def flash_upload_verify(port, sectors, window=2, log=None, cache=None, journal=None, rounds=2):
+    '''Upload sectors, read them back and upload the ones that differ again,
+    up to rounds times. Returns list of addresses of sectors that still differ
+    or were not written at all.'''
+    log = log or sys.stderr.write
+    written = flash_upload_sectors(port, sectors, window, log, cache, journal)
+    missing = flash_unwritten(sectors, written)
+    for r in range(rounds+1):
+        bad = flash_verify(port, sectors, written, log=log, cache=cache)
+        if not bad or r == rounds: break
+        log('%d sectors differ, writing them again\n'%len(bad))
+        sectors = [sectors[i] for address, i in bad]
+        written = flash_upload_sectors(port, sectors, window, log, cache, journal)
+        missing += flash_unwritten(sectors, written)
+    return sorted([address for address, i in bad] + missing)
+
+##############################################################################
+## Flash retrieval functions
+
+def flash_request_blob(port, page):
+    '''send request for a flash blob to midi device by page'''
+    data = [0xf0, 0x00, 0x20, 0x32, 0x7f, 0x7f, 0x74, page>>7, page&0x7f, 0xf7]
+    port.send_sysex(data, time.time()+1)
+
+def flash_blob_pages(sysex):
+    '''return the page numbers a flash blob received from the device may be
+       for: the address read as 7-bit halves, like the request, and as 8-bit
+       halves, like firmware packets. The two agree below page 0x100.'''
+    arg = syx_decode(syx_implode(bytearray(sysex[7:7+8])))
+    return (arg[0]<<7) + arg[1], (arg[0]<<8) + arg[1]
+
+def flash_get_blobs(port, addr, count, window=4, retries=3, log=None, cache=None, journal=None):
+    '''request flash address range from midi device and return dict of
+    blobs by page. Up to window pages are requested ahead; replies are matched
+    by their address (see flash_blob_pages), and pages that did not arrive
+    are requested again up to retries times. Pages found in the journal are not requested again.'''
+    if addr&0xff: raise BCFWException('Start address must be a multiple of 0x100')
+    if count&0xff: raise BCFWException('Count must be a multiple of 0x100')
+    log = log or sys.stderr.write
+    rtt = port.estimator(0x74, *_blobtimeout)
+    starttime, receivedbefore = time.time(), port.received
+    queue = range(addr/0x100, (addr+count)/0x100)   # pages to request
+    pending = []                    # pages requested but not received yet
+    sent = {}                       # time each page was requested
+    tries = dict.fromkeys(queue, 0)
+    blobs = {}
+    if journal:
+        for page in [p for p in queue if journal.get(p*0x100)]:
+            blobs[page] = list(journal.data(page*0x100))
+            queue.remove(page)
+    count = len(queue)*0x100        # bytes to be transferred
+    while queue or pending:
+        # keep the window filled
+        while queue and len(pending) < window:
+            page = queue.pop(0)
+            flash_request_blob(port, page)
+            sent[page] = time.time()
+            tries[page] += 1
+            pending.append(page)
+        # receive dump, but allow for sending the packet back
+        deadline = sent[pending[0]] + rtt.timeout
+        sysex = port.recv_sysex(deadline)
+        while midi_check_sysex(sysex, [0x34, 0x74], False) == 0x74:
+            sysex = port.recv_sysex(deadline)
+        if not sysex:
+            # whatever is still outstanding is lost; ask again more gently
+            rtt.backoff()
+            if port.stats: port.stats.count('page retries', len(pending))
+            for page in pending:
+                if tries[page] > retries:
+                    raise BCFWException("timeout waiting for flash blob 0x%06x from device"%(page*0x100))
+            queue = pending + queue
+            pending = []
+            window = max(window/2, 1)
+            continue
+        midi_check_sysex(sysex, [0x34])
+        matches = [p for p in flash_blob_pages(sysex) if p in pending]
+        if not matches: continue            # late reply to a retried request
+        page = matches[0]
+        pending.remove(page)
+        if tries[page] == 1: rtt.sample(time.time() - sent[page])
+        if port.stats: port.stats.sample('page round trip', time.time()-sent[page])
+        # change command to avoid bricking device when writing it back accidentally
+        sysex[6] = 0x74
+        blobs[page] = sysex
+        if journal: journal.add(page*0x100, bytearray(sysex), True)
+        log('0x%06x-0x%06x\r'%(page*0x100,page*0x100+0x100))
+    elapsed = time.time() - starttime
+    if port.stats: port.stats.add('retrieve', elapsed, port.received-receivedbefore)
+    log('\nretrieved %d bytes in %.1f s (%.1f kB/s, wire %s, timeout %.0f ms)\n'%(count, elapsed, count/1024.0/max(elapsed, 1e-3), port.throughput(port.received-receivedbefore, elapsed), rtt.timeout*1000))
+    if cache: cache.update(addr, flash_blobs_data(blobs))
+    return blobs
+
+def flash_blobs_data(blobs):
+    '''return memory contents of a dict of blobs by page, checking the address
+       and checksum of each'''
+    data = bytearray()
+    lastpage = None
+    for page in sorted(blobs):
+        if lastpage is not None and page != lastpage+1:
+            raise BCFWException("No jump in flash addresses allowed: 0x%06x->0x%06x"%(lastpage*0x100, page*0x100))
+        if not page in flash_blob_pages(blobs[page]):
+            raise BCFWException("Flash blob for 0x%06x has another address"%(page*0x100))
+        data += syx_parse_packet(bytearray(blobs[page][7:-1]), None)[0]
+        lastpage = page
+    return data
+
+def flash_get(port, addr, count, window=4, retries=3, log=None, cache=None, journal=None):
+    '''request flash address range from midi device as sysex data'''
+    blobs = flash_get_blobs(port, addr, count, window, retries, log, cache, journal)
+    data = []
+    for page in sorted(blobs): data += blobs[page]
+    return data
+
+def flash_read(port, addr, count, window=4, retries=3, log=None, cache=None):
+    '''request flash address range from midi device as memory contents'''
+    return flash_blobs_data(flash_get_blobs(port, addr, count, window, retries, log, cache))
+
+##############################################################################
+## Link functions
+
+def flash_link(port, link='usb', log=None):
+    '''Pace sending to the device to the wire rate of the link type, 'usb' or
+    'din'. With 'auto' it is told from the time a flash page takes to arrive,
+    which is about 0.1 s over din midi. Only when the device does not answer
+    at all is din assumed, with a warning, since that is the only link rescue
+    mode works with. Returns the link type.'''
+    log = log or sys.stderr.write
+    if link == 'auto':
+        # drop what is left of an earlier transfer, like a late acknowledgement
+        while port.recv_sysex(time.time()+0.05): pass
+        link = 'din'
+        starttime = time.time()
+        flash_request_blob(port, 0)
+        sysex = port.recv_sysex(starttime+1)
+        # skip the request coming back and anything else but the page
+        while sysex and (midi_check_sysex(sysex, [0x34], False) != 0x34 or not 0 in flash_blob_pages(sysex)):
+            sysex = port.recv_sysex(starttime+1)
+        if not sysex:
+            log('warning: no reply to a flash page request, assuming a din link; choose the link to avoid this\n')
+        # the request has to arrive before the reply is sent, so count it too
+        elif (len(sysex)+10)/(time.time()-starttime) > 2*midi_linkrates['din']:
+            link = 'usb'
+        # drop a reply that arrived late
+        while port.recv_sysex(time.time()+0.05): pass
+    if not link in midi_linkrates:
+        raise BCFWException("unknown link type %s"%link)
+    port.pace(midi_linkrates[link])
+    if port.rate: log('%s link, sending at %.1f kB/s\n'%(link, port.rate/1024.0))
+    return link
+
+##############################################################################
+## Fleet functions
+
+def flash_fleet(devices, data, window=2, verify=False, changedonly=False, cachefor=None, journalfor=None, link=None, stats=None):
+    '''Upload sysex firmware data to several devices at once, each in its own
+    thread. Progress is shown on a single line. With changedonly, only sectors
+    that differ from the device's flash are written. When given, cachefor and
+    journalfor return the flash cache and journal of a device by name, and
+    sending is paced to the link type (see flash_link). Transfers of all
+    devices are recorded in stats, if given.
+    Returns dict of error message (or None on success) by device name.'''
+    sectors = flash_sectors(data)
+    status = dict.fromkeys(devices, 'waiting')
+    results = {}
+    lock = threading.Lock()
+    def show(devname, msg):
+        lock.acquire()
+        try:
+            # warnings get their own line, progress is shown side by side
+            if msg.strip() and not msg.endswith('\r'):
+                sys.stderr.write('\n%s: %s\n'%(devname, msg.strip()))
+            if msg.strip(): status[devname] = msg.strip()
+            sys.stderr.write(' '.join(['%s %s'%(d, status[d]) for d in devices])+'\r')
+        finally:
+            lock.release()
+    def run(devname):
+        log = lambda msg: show(devname, msg)
+        try:
+            port = MidiPort(devname)
+            port.stats = stats
+            cache = cachefor and cachefor(devname)
+            journal = journalfor and journalfor(devname)
+            try:
+                if link: flash_link(port, link, log)
+                todo = sectors
+                if journal: todo = flash_resume(todo, journal)
+                if changedonly:
+                    log('comparing\r')
+                    todo = flash_changed(port, todo, log=lambda msg: None, cache=cache)
+                if verify:
+                    bad = flash_upload_verify(port, todo, window, log, cache, journal)
+                    if bad: raise BCFWException('verify failed at ' + ', '.join(['0x%06x'%a for a in bad]))
+                elif flash_unwritten(todo, flash_upload_sectors(port, todo, window, log, cache, journal)):
+                    raise BCFWException('not all sectors were written')
+                if journal: journal.finish()
+            finally:
+                port.close()
+                if cache: cache.save()
+            results[devname] = None
+            log('done\r')
+        except (BCFWException, EnvironmentError), e:
+            results[devname] = str(e).strip()
+            log('failed\r')
+        except Exception, e:
+            # anything else is a bug, but should not hide the other devices
+            results[devname] = '%s: %s'%(e.__class__.__name__, e)
+            log('failed\r')
+    threads = [threading.Thread(target=run, args=(d,)) for d in devices]
+    for t in threads: t.start()
+    for t in threads: t.join()
+    sys.stderr.write('\n')
+    return results
+
+##############################################################################
+## Special feature functions
+
+def send_display(port, s):
+    '''Send a 4-character string to the display. If the string is "boot" the
+    device will reboot.'''
+    # construct packet argument
+    arg  = [0xff, 0x00]             # special address
+    arg += [0x00]                   # checksum (compute later)
+    arg += str2array(s[0:4])        # string
+    arg += [0]*(0x100-4)            # padding
+    arg[2] = syx_checksum(arg[3:])
+    # construct packet
+    data  = [0xf0, 0x00, 0x20, 0x32, 0x7f, 0x7f, 0x34] # firmware send packet
+    data += syx_explode(syx_decode(arg))
+    data += [0xf7]                  # end of sysex
+    port.send_sysex(data, time.time()+1)
+
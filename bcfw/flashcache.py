@@ -0,0 +1,116 @@
+#
+#  Unofficial Behringer Control Development Kit - flash image cache
+#
+#  Copyright (C) 2010 Willem van Engen <dev-bc2000@willem.engen.nl>
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License along
+#  with this program; if not, write to the Free Software Foundation, Inc.,
+#  51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+
+import os, json, random, hashlib
+
+from bcfw.util import cache_path
+from bcfw.flash import flash_read
+
+##############################################################################
+## Flash image cache
+
+def flash_cache_name(devname, ident):
+    '''return name of the device attached to a midi device node, which stays
+       the same when it is plugged in again at the same place; ident is its
+       identity as returned by midi_probe, so that a device of another model
+       or firmware version attached there gets another name'''
+    sysfs = '/sys/class/sound/%s/device'%os.path.basename(devname)
+    if os.path.exists(sysfs): name = os.path.realpath(sysfs)
+    else: name = os.path.realpath(devname)
+    if ident: name += ' %s %s'%(ident[0], ident[1])
+    return name
+
+class FlashCache(object):
+    '''Last known flash contents of a device, kept on disk together with a
+    hash of each 4k sector whose contents are known. The flash functions
+    update it as they write and read sectors.'''
+
+    size = 0x80000
+
+    def __init__(self, name, cachedir=None):
+        self.name = name
+        self.dir = os.path.join(cachedir or cache_path('flash'), hashlib.sha1(name).hexdigest())
+        self.image = bytearray('\xff')*self.size
+        self.hashes = {}            # sector address -> hash of known sectors
+        self.load()
+
+    def hash(self, address):
+        '''return hash of a sector in the image'''
+        return hashlib.sha1(buffer(self.image, address, 0x1000)).hexdigest()
+
+    def load(self):
+        '''read cache from disk, keeping only sectors that match their hash'''
+        try:
+            index = json.load(open(os.path.join(self.dir, 'sectors')))
+            image = open(os.path.join(self.dir, 'image'), 'rb').read()
+        except (EnvironmentError, ValueError):
+            return
+        if len(image) != self.size or not isinstance(index, dict): return
+        self.image = bytearray(image)
+        for address, h in index.get('sectors', {}).items():
+            if self.hash(int(address, 0)) == h: self.hashes[int(address, 0)] = h
+
+    def save(self):
+        '''write cache to disk, if possible'''
+        index = {'name': self.name, 'sectors': dict([('0x%06x'%a, h) for a, h in self.hashes.items()])}
+        try:
+            if not os.path.isdir(self.dir): os.makedirs(self.dir)
+            for fname, data in [('image', str(self.image)), ('sectors', json.dumps(index))]:
+                tmpfile = os.path.join(self.dir, '%s.%d'%(fname, os.getpid()))
+                f = open(tmpfile, 'wb')
+                f.write(data)
+                f.close()
+                os.rename(tmpfile, os.path.join(self.dir, fname))
+        except EnvironmentError:
+            pass
+
+    def update(self, address, data):
+        '''record flash contents at address; sectors become known when they are
+           fully covered by data or were known already'''
+        self.image[address:address+len(data)] = data
+        for sector in range(address & ~0xfff, address+len(data), 0x1000):
+            if (sector >= address and sector+0x1000 <= address+len(data)) or sector in self.hashes:
+                self.hashes[sector] = self.hash(sector)
+
+    def invalidate(self, address):
+        '''forget contents of the sector at address'''
+        self.hashes.pop(address & ~0xfff, None)
+
+    def clear(self):
+        '''forget all contents'''
+        self.hashes = {}
+
+    def get(self, address, count):
+        '''return flash contents of a range, or None if it is not all known'''
+        for sector in range(address & ~0xfff, address+count, 0x1000):
+            if not sector in self.hashes: return None
+        return self.image[address:address+count]
+
+    def sample(self, port, count=4):
+        '''read back a few random pages of the known sectors from the device;
+           when one differs the cache is stale, so clear it and return False'''
+        sectors = self.hashes.keys()
+        for i in range(count):
+            if not sectors: break
+            page = random.choice(sectors) + random.randrange(0x10)*0x100
+            if flash_read(port, page, 0x100, 1, log=lambda msg: None) != self.image[page:page+0x100]:
+                self.clear()
+                return False
+        return True
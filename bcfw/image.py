@@ -0,0 +1,60 @@
+#
+#  Unofficial Behringer Control Development Kit - binary images
+#
+#  Copyright (C) 2010 Willem van Engen <dev-bc2000@willem.engen.nl>
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License along
+#  with this program; if not, write to the Free Software Foundation, Inc.,
+#  51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+
+import mmap, struct
+
+class BinaryImage(object):
+    '''Read-only binary image of a file, like a flash dump or os image.
+
+    Regular files are memory-mapped, so slices and unpacking read straight
+    from the page cache without copying. Anything that cannot be mapped,
+    like a pipe or standard input, is read into memory instead.'''
+
+    def __init__(self, f):
+        '''open image from a file name or file object'''
+        self._file = None
+        if isinstance(f, basestring):
+            f = self._file = open(f, 'rb')
+        try:
+            self._data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except (AttributeError, EnvironmentError, ValueError):
+            # not a regular file, or empty
+            self._data = f.read()
+
+    def __len__(self):
+        return len(self._data)
+
+    def __getitem__(self, key):
+        '''return byte value, or zero-copy buffer for a slice'''
+        if isinstance(key, slice):
+            start, stop, step = key.indices(len(self._data))
+            if step != 1: raise ValueError('slice step not supported')
+            return buffer(self._data, start, max(0, stop-start))
+        return ord(self._data[key])
+
+    def unpack(self, fmt, offset=0):
+        '''return values unpacked by struct format at offset'''
+        return struct.unpack_from(fmt, self._data, offset)
+
+    def close(self):
+        if isinstance(self._data, mmap.mmap): self._data.close()
+        if self._file: self._file.close()
+        self._data = ''
+        self._file = None
@@ -0,0 +1,104 @@
+#
+#  Unofficial Behringer Control Development Kit - transfer journal
+#
+#  Copyright (C) 2010 Willem van Engen <dev-bc2000@willem.engen.nl>
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License along
+#  with this program; if not, write to the Free Software Foundation, Inc.,
+#  51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+
+import os, binascii, hashlib
+
+from bcfw.util import cache_path
+
+##############################################################################
+## Transfer journal
+
+#
+# The journal is a text file that starts with a line describing the operation,
+# followed by a line for each sector or page that was completed:
+#   <address> <sha1 of data> [<data in hex>]
+# Lines are written as soon as the sector or page is done, so that the file
+# is useful after an interruption; an incomplete last line is ignored.
+#
+
+class Journal(object):
+    '''Record of the sectors or pages completed by an upload or retrieval, so
+    that it can be resumed after an interruption.'''
+
+    def __init__(self, filename, operation, resume=False):
+        self.filename = filename
+        self.operation = operation
+        self.done = {}              # address -> (digest, data or None)
+        if resume: self.load()
+        if not os.path.isdir(os.path.dirname(filename)):
+            os.makedirs(os.path.dirname(filename))
+        self.f = open(filename, 'w')
+        self.f.write('# bcfw journal %s\n'%operation)
+        for address in sorted(self.done):
+            self.write(address, *self.done[address])
+        self.finished = False
+
+    def load(self):
+        '''read completed entries of the same operation from the file'''
+        try:
+            lines = open(self.filename).read().split('\n')
+        except EnvironmentError:
+            return
+        if lines[0] != '# bcfw journal %s'%self.operation: return
+        # the last element is empty or an incomplete line
+        for line in lines[1:-1]:
+            fields = line.split(' ')
+            try:
+                address, digest = int(fields[0], 0), fields[1]
+                data = None
+                if len(fields) > 2: data = bytearray(binascii.unhexlify(fields[2]))
+            except (IndexError, ValueError, TypeError):
+                continue
+            if data is None or hashlib.sha1(data).hexdigest() == digest:
+                self.done[address] = (digest, data)
+
+    def write(self, address, digest, data=None):
+        line = '0x%06x %s'%(address, digest)
+        if data is not None: line += ' ' + binascii.hexlify(data)
+        self.f.write(line + '\n')
+        self.f.flush()
+
+    def add(self, address, data, keep=False):
+        '''record that data was completed at address; with keep, the data
+           itself is stored as well'''
+        digest = hashlib.sha1(data).hexdigest()
+        if not keep: data = None
+        self.done[address] = (digest, data and bytearray(data))
+        self.write(address, digest, data)
+
+    def get(self, address, data=None):
+        '''return whether address was completed; when data is given it must
+           match what was recorded'''
+        if not address in self.done: return False
+        return data is None or self.done[address][0] == hashlib.sha1(data).hexdigest()
+
+    def data(self, address):
+        '''return data recorded for address'''
+        return self.done[address][1]
+
+    def finish(self):
+        '''remove the journal after the operation has completed'''
+        self.f.close()
+        os.remove(self.filename)
+        self.finished = True
+
+def journal_open(operation, resume=False):
+    '''return journal for an operation, which is kept in the cache directory'''
+    return Journal(cache_path('journal', hashlib.sha1(operation).hexdigest()), operation, resume)
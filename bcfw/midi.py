@@ -0,0 +1,332 @@
+#
+#  Unofficial Behringer Control Development Kit - midi device access
+#
+#  Copyright (C) 2010 Willem van Engen <dev-bc2000@willem.engen.nl>
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License along
+#  with this program; if not, write to the Free Software Foundation, Inc.,
+#  51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+
+import sys, os, re, glob, select, fcntl, errno, time, json
+
+from bcfw.util import BCFWException, array2str, cache_path
+
+##############################################################################
+## Midi device functions
+
+# realtime messages are single bytes that may appear anywhere, even in sysex
+_midirealtime = ''.join(map(chr, range(0xf8, 0x100)))
+_sysexbytes = re.compile('[\xf0\xf7]')
+
+class SysexReader(object):
+    '''Buffered reader that splits midi input into sysex messages. Input is
+    fed in chunks of whatever is available (MidiPort reads them), and an
+    incomplete message is kept until the rest of it arrives.'''
+
+    def __init__(self, f, size=0x1000):
+        self.fd = f.fileno()
+        self.size = size
+        self.messages = []          # complete messages not returned yet
+        self.partial = None         # message being received
+
+    def feed(self, data):
+        '''add received data, splitting off complete messages'''
+        data = str(data).translate(None, _midirealtime)
+        pos = 0
+        for m in _sysexbytes.finditer(data):
+            i = m.start()
+            if self.partial is not None:
+                self.partial += data[pos:i]
+            if data[i] == '\xf0':
+                # a start byte aborts any message that was not finished
+                self.partial = bytearray('\xf0')
+            elif self.partial is not None:
+                self.partial.append(0xf7)
+                self.messages.append(list(self.partial))
+                self.partial = None
+            pos = i + 1
+        if self.partial is not None:
+            self.partial += data[pos:]
+
+class RttEstimator(object):
+    '''Timeout for replies from a smoothed round trip time and its variation,
+    computed like TCP's retransmission timeout. Only replies to requests that
+    were sent once should be sampled.'''
+
+    def __init__(self, initial, minimum, maximum):
+        self.srtt = None
+        self.rttvar = None
+        self.timeout = initial
+        self.minimum = minimum
+        self.maximum = maximum
+
+    def sample(self, rtt):
+        '''update with measured round trip time'''
+        if self.srtt is None:
+            self.srtt, self.rttvar = rtt, rtt/2
+        else:
+            self.rttvar = 0.75*self.rttvar + 0.25*abs(self.srtt - rtt)
+            self.srtt = 0.875*self.srtt + 0.125*rtt
+        self.timeout = min(max(self.srtt + 4*self.rttvar, self.minimum), self.maximum)
+
+    def backoff(self):
+        '''double the timeout after a reply did not arrive in time'''
+        self.timeout = min(self.timeout*2, self.maximum)
+
+# bytes per second on the wire of each link type: din midi sends 10 bits per
+# byte at 31250 baud, usb is not limited by a midi wire
+midi_linkrates = {'usb': None, 'din': 3125}
+
+class MidiPort(SysexReader):
+    '''Midi device opened for non-blocking sysex transfers. Sending and
+    receiving take a deadline in seconds since the epoch (as time.time()), or
+    None to wait as long as needed; no call ever waits past its deadline.
+    Sending can be paced to the rate of the link with a token bucket, so that
+    interfaces with small buffers are not overrun.'''
+
+    def __init__(self, f, size=0x1000):
+        if isinstance(f, basestring): f = open(f, 'r+b', 0)
+        SysexReader.__init__(self, f, size)
+        self.f = f
+        self.name = getattr(f, 'name', None)
+        self.rtt = {}               # round trip estimator by command
+        self.rate = None            # bytes per second sending is paced to
+        self.burst = 0              # bytes that may be sent at once
+        self.tokens = 0             # bytes that may be sent now
+        self.filled = 0             # time the tokens were last added
+        self.sent = 0               # number of bytes sent and received
+        self.received = 0
+        self.stats = None           # statistics of transfers, if wanted
+        flags = fcntl.fcntl(self.fd, fcntl.F_GETFL)
+        fcntl.fcntl(self.fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+
+    def fileno(self):
+        return self.fd
+
+    def close(self):
+        self.f.close()
+
+    def estimator(self, cmd, initial, minimum, maximum):
+        '''return round trip estimator of this device for a command, created
+           with initial, minimum and maximum timeout when first used'''
+        if not cmd in self.rtt: self.rtt[cmd] = RttEstimator(initial, minimum, maximum)
+        return self.rtt[cmd]
+
+    def pace(self, rate, burst=32):
+        '''limit sending to rate bytes per second in bursts of up to burst
+           bytes, or remove the limit when rate is None'''
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.filled = time.time()
+
+    def credit(self, count, deadline):
+        '''wait until up to count bytes may be sent at the paced rate, and
+           return how many'''
+        count = min(count, self.burst)
+        while True:
+            now = time.time()
+            self.tokens = min(self.tokens + (now - self.filled)*self.rate, self.burst)
+            self.filled = now
+            if self.tokens >= count: return count
+            delay = (count - self.tokens)/self.rate
+            if deadline is not None and now + delay > deadline:
+                raise BCFWException("timeout sending to midi device")
+            time.sleep(delay)
+
+    def throughput(self, count, elapsed):
+        '''return description of the rate at which count bytes were sent or
+           received in elapsed seconds, and the rate of the link when known'''
+        s = '%.1f'%(count/1024.0/max(elapsed, 1e-3))
+        if self.rate: s += ' of %.1f'%(self.rate/1024.0)
+        return s + ' kB/s'
+
+    def wait(self, write, deadline):
+        '''wait until the device can be read or written; return False if the
+           deadline passed first'''
+        timeout = None
+        if deadline is not None: timeout = max(deadline - time.time(), 0)
+        fds = [self.fd]
+        if write: r, w, x = select.select([], fds, [], timeout)
+        else: r, w, x = select.select(fds, [], [], timeout)
+        return bool(r or w)
+
+    def send_sysex(self, data, deadline=None):
+        '''send message(s) given as string, bytearray or list of bytes'''
+        data = str(bytearray(data))
+        while data:
+            count = len(data)
+            if self.rate: count = self.credit(count, deadline)
+            if not self.wait(True, deadline):
+                raise BCFWException("timeout sending to midi device")
+            try:
+                count = os.write(self.fd, data[:count])
+                data = data[count:]
+                self.sent += count
+                if self.rate: self.tokens -= count
+            except OSError, e:
+                if e.errno != errno.EAGAIN: raise BCFWException("error sending to midi device: %s"%e.strerror)
+
+    def recv_sysex(self, deadline=None):
+        '''return next sysex message, or None when the deadline has passed'''
+        while not self.messages:
+            if not self.wait(False, deadline): return None
+            try:
+                data = os.read(self.fd, self.size)
+            except OSError, e:
+                if e.errno == errno.EAGAIN: continue
+                raise BCFWException("error receiving from midi device: %s"%e.strerror)
+            if not data: return None
+            self.received += len(data)
+            self.feed(data)
+        return self.messages.pop(0)
+
+# smallest length of a message of each command that has arguments: firmware
+# packets and flash pages (34), and sector acknowledgements (35)
+_sysexlengths = {0x34: 304, 0x35: 11}
+
+def midi_check_sysex(sysex, cmds, exceptions = True):
+    '''check if the response was a valid sysex blob message and return command'''
+    try:
+        if not sysex:
+            raise BCFWException("timeout waiting for flash blob from device")
+        if len(sysex) < 8 or len(sysex) < _sysexlengths.get(sysex[6], 0):
+            raise BCFWException("sysex message of %d bytes is too short"%len(sysex))
+        if not sysex[1:4] == [0x00, 0x20, 0x32]:
+            raise BCFWException("unexpected sysex manufacturer received: 0x%02x,0x%02x,0x%02x"%(sysex[1],sysex[2],sysex[3]))
+        if not sysex[6] in cmds:
+            raise BCFWException("unexpected sysex response command received: 0x%02x"%sysex[6])
+        return sysex[6]
+    except BCFWException, e:
+        if not exceptions: return None
+        raise e
+
+def midi_devices():
+    '''return device names of all midi devices, and of those listed in the
+       environment variable BCFW_MIDI_DEVICES separated by colons (such as
+       emulated devices)'''
+    if os.path.isdir("/dev/snd"):
+        devices = glob.glob("/dev/snd/midi*")
+    else:
+        devices = glob.glob("/dev/midi*")
+    devices += [d for d in os.environ.get('BCFW_MIDI_DEVICES', '').split(':') if d]
+    if not devices:
+        raise BCFWException("No midi devices found")
+    return devices
+
+def midi_parse_identity(sysex):
+    '''return (model name, firmware version, model id) from identity reply'''
+    ident = array2str(sysex[7:-1]).split(' ', 1)
+    if len(ident) < 2: ident.append('')
+    return ident[0], ident[1], sysex[5]
+
+def midi_probe(devices, timeout=1, verbose=False):
+    '''send identity request to all devices at once and wait for the replies
+    until a common deadline. Returns dict by device name of the identity (see
+    midi_parse_identity) of each device that could be opened, None for those
+    that have no Behringer Control device attached.'''
+    deadline = time.time() + timeout
+    ports = {}
+    for devname in devices:
+        try:
+            port = MidiPort(devname)
+        except:
+            if verbose: sys.stderr.write("warning: could not open midi device %s\n"%devname)
+            continue
+        try:
+            port.send_sysex([0xf0, 0x00, 0x20, 0x32, 0x7f, 0x7f, 0x01, 0xf7], deadline)
+            ports[port.fd] = port
+        except BCFWException:
+            port.close()
+    result = {}
+    for port in ports.values(): result[port.name] = None
+    # wait for replies from any device until all are in or time is up
+    while ports:
+        ready = select.select(ports.keys(), [], [], max(deadline - time.time(), 0))[0]
+        if not ready: break
+        for fd in ready:
+            # skip anything else, like replies left over from earlier requests
+            recvd = ports[fd].recv_sysex(time.time())
+            while recvd and midi_check_sysex(recvd, [0x02], False) != 0x02:
+                recvd = ports[fd].recv_sysex(time.time())
+            if recvd:
+                result[ports[fd].name] = midi_parse_identity(recvd)
+                ports.pop(fd).close()
+    for port in ports.values(): port.close()
+    return result
+
+##############################################################################
+## Midi device identity cache
+
+_cachefile = cache_path('devices')
+
+def midi_device_key(devname):
+    '''return string that identifies a device node and what is attached to
+       it; this changes when the device is plugged in again'''
+    st = os.stat(devname)
+    sysfs = os.path.realpath('/sys/class/sound/%s/device'%os.path.basename(devname))
+    return '%s %x %d %s'%(devname, st.st_rdev, int(st.st_ctime), sysfs)
+
+def midi_cache_load():
+    '''return identities of devices that answered before from cache by key'''
+    try:
+        cache = json.load(open(_cachefile))
+    except (EnvironmentError, ValueError):
+        return {}
+    if not isinstance(cache, dict): return {}
+    return dict([(k, tuple(v)) for k, v in cache.items() if v])
+
+def midi_cache_save(cache):
+    '''write identities of devices by key to cache, if possible'''
+    try:
+        if not os.path.isdir(os.path.dirname(_cachefile)):
+            os.makedirs(os.path.dirname(_cachefile))
+        tmpfile = '%s.%d'%(_cachefile, os.getpid())
+        json.dump(cache, open(tmpfile, 'w'))
+        os.rename(tmpfile, _cachefile)
+    except EnvironmentError:
+        pass
+
+def midi_detect(verbose=False, findall=False, usecache=True):
+    '''detect midi devices that have a Behringer Control device attached.
+    Devices are probed all at once. Unless usecache is False, the devices
+    that answered last time are asked first; when looking for a single device
+    and one of them still answers, the others need not be probed. Only
+    devices that answered are remembered, and what is reported always comes
+    from a reply of this run.'''
+    devices = midi_devices()
+    cache = usecache and midi_cache_load() or {}
+    keys = {}
+    for devname in devices:
+        try: keys[devname] = midi_device_key(devname)
+        except OSError: pass
+    known = [d for d in devices if keys.get(d) in cache]
+    idents = {}
+    if known and not findall: idents = midi_probe(known, 1, verbose)
+    if findall or not [d for d in idents if idents[d]]:
+        idents.update(midi_probe([d for d in devices if not d in idents], 1, verbose))
+    # remember the devices that answered
+    newcache = {}
+    for devname in devices:
+        if idents.get(devname) and devname in keys: newcache[keys[devname]] = idents[devname]
+    midi_cache_save(newcache)
+    # find matching id responses on each device
+    founddevnames = []
+    for devname in devices:
+        if not idents.get(devname): continue
+        if verbose: sys.stderr.write("%s:\t%s %s\n"%(devname, idents[devname][0], idents[devname][1]))
+        if not findall: return devname
+        founddevnames.append(devname)
+    if not findall: return None
+    return founddevnames
@@ -0,0 +1,105 @@
+#
+#  Unofficial Behringer Control Development Kit - os image handling
+#
+#  Copyright (C) 2010 Willem van Engen <dev-bc2000@willem.engen.nl>
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License along
+#  with this program; if not, write to the Free Software Foundation, Inc.,
+#  51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+
+import array, operator
+
+from bcfw.util import BCFWException, numpy, wunpack, wpack, bytes2words, words2bytes, wordtype
+
+##############################################################################
+## OS image handling
+
+_oscipher1 = [ 0x2726534c, 0x3971212d, 0x71167b24, 0x69272171, 0x3b652f24,
+               0x30293644, 0x541a183f, 0x2c3f7c31, 0x29287d28, 0x5648553d,
+               0x4c4f1257, 0x31677518, 0x2e2e186a, 0x00554400, 0x44554d4d ]
+
+_oscipher2 = [ 0x75697361, 0x77386664, 0x33363765, 0x20756934, 0x6920686a,
+               0x74667564, 0x7437387a, 0x756f3372, 0x616f347a, 0x667a7569,
+               0x616f2067, 0x74203738, 0x747a3738, 0x00756920 ]
+
+def os_decodeword(wordin, offset):
+    '''encode/decode a 32bit word of data with cipher offset'''
+    return wordin \
+        ^ _oscipher1[offset % len(_oscipher1)] \
+        ^ _oscipher2[offset % len(_oscipher2)]
+
+# Both ciphers repeat, so their combination repeats every 15*14=210 words.
+# Likewise the magic that goes into the checksum is rotated one bit per word,
+# so it repeats every 32 words. Both sequences are computed only once.
+_oskeystream = [ os_decodeword(0, i) for i in range(len(_oscipher1)*len(_oscipher2)) ]
+_osdmagic = [ ((0x42474552>>i) | (0x42474552<<(32-i))) & 0xffffffff for i in range(1,33) ]
+if numpy:
+    _oskeystream = numpy.array(_oskeystream, numpy.uint32)
+    _osdmagic = numpy.array(_osdmagic, numpy.uint32)
+
+def _os_periodic(seq, offset, count):
+    '''return count items of periodic sequence seq starting at index offset'''
+    offset %= len(seq)
+    if numpy: return numpy.resize(numpy.roll(seq, -offset), count)
+    return (seq * ((offset+count)/len(seq)+1))[offset:offset+count]
+
+def os_decodewords(words, offset):
+    '''encode/decode an array of 32bit words with cipher offset of first word'''
+    key = _os_periodic(_oskeystream, offset, len(words))
+    if numpy: return words ^ key
+    return array.array(wordtype, map(operator.xor, words, key))
+
+def os_checksum(words):
+    '''return checksum of an array of 32bit words of os image'''
+    dmagic = _os_periodic(_osdmagic, 0, len(words))
+    if numpy: return int((words ^ dmagic).sum(dtype=numpy.uint64)) & 0xffffffff
+    return sum(map(operator.xor, words, dmagic)) & 0xffffffff
+
+def dump2os(idata):
+    '''convert a dump of the os flash to an os image'''
+    # first two words are special
+    header = bytearray(idata[0:8])
+    size = os_decodeword(wunpack(header[0:4]), 0)
+    #size = len(idata)-8
+    origsum = os_decodeword(wunpack(header[4:8]), 1)
+    #sys.stderr.write("header: size=0x%x, checksum=0x%x\n"%(size, origsum))
+    # make sure size matches
+    if size <= 0 or ((size+3)/4)*4+0x2008 > 0x7ffff:
+        raise BCFWException("Bad size field: 0x%x must be between 0 and 0x%x"%(size, 0x7ffff-0x2008));
+    if len(idata) < ((size+3)/4)*4+8:
+        raise BCFWException("Truncated image: 0x%x bytes should be 0x%x"%(len(idata)-8, size))
+    # deobfuscate and verify checksum
+    words = os_decodewords(bytes2words(buffer(idata, 8, ((size+3)/4)*4)), 2)
+    checksum = os_checksum(words)
+    if checksum != origsum:
+        raise BCFWException("Corrupt image: checksum mismatch 0x%x should be 0x%x"%(checksum, origsum))
+    return words2bytes(words)
+
+def os2dump(idata):
+    '''convert an os image to a flashdump portion'''
+    size = len(idata)
+    # length validation and checksum
+    if size <= 0 or ((size+3)/4)*4+0x2008 > 0x7ffff:
+        raise BCFWException("Bad size: 0x%x must be between 0 and 0x%x"%(size, 0x7ffff-0x2008));
+    # fill 4k page with 0xff as official firmware does
+    #idata = idata + [0] * (4-(len(idata)%4))
+    idata = bytearray(idata) + bytearray([0xff]) * ((0x1000 - ((size+8)%0x1000))%0x1000)
+    # checksum (but not for filler bytes) and obfuscate
+    words = bytes2words(idata)
+    checksum = os_checksum(words[:(size+3)/4])
+    odata = bytearray(wpack(os_decodeword(size, 0)))
+    odata += bytearray(wpack(os_decodeword(checksum, 1)))
+    odata += words2bytes(os_decodewords(words, 2))
+    return odata
+
@@ -0,0 +1,200 @@
+#
+#  Unofficial Behringer Control Development Kit - timing statistics
+#
+#  Copyright (C) 2010 Willem van Engen <dev-bc2000@willem.engen.nl>
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License along
+#  with this program; if not, write to the Free Software Foundation, Inc.,
+#  51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+
+import sys, time, json, threading
+
+from bcfw.util import BCFWException
+from bcfw.codec import syx_implode, syx_explode, syx_decode, syx_decode_write, syx_checksum
+from bcfw.osimage import os_decodewords, os_checksum
+
+##############################################################################
+## Timing statistics
+
+#
+# Nothing is measured until stats_enable() is called: it replaces the codec
+# functions by timed versions, and transfers are only timed on ports that have
+# a Stats object assigned (MidiPort.stats). Time spent in a phase excludes
+# that of phases it calls, so the phases add up.
+#
+
+# codec functions timed by phase
+_phases = [
+    ('implode', syx_implode),
+    ('explode', syx_explode),
+    ('cipher', syx_decode),
+    ('cipher', syx_decode_write),
+    ('cipher', os_decodewords),
+    ('checksum', syx_checksum),
+    ('checksum', os_checksum),
+]
+
+# upper bounds of the latency histogram buckets in ms
+_buckets = [1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000]
+
+def _size(data):
+    '''return number of bytes of a bytearray, string, array or numpy array'''
+    if hasattr(data, 'nbytes'): return data.nbytes
+    return len(data) * getattr(data, 'itemsize', 1)
+
+class Stats(object):
+    '''Time and bytes spent per phase, latency samples and counters.'''
+
+    def __init__(self):
+        self.phases = {}            # name -> [calls, seconds, bytes]
+        self.latencies = {}         # name -> list of seconds
+        self.counters = {}          # name -> count
+        self.nested = threading.local()
+        self.starttime = time.time()
+
+    def add(self, phase, seconds, count=0):
+        '''record time spent in a phase, processing count bytes'''
+        p = self.phases.setdefault(phase, [0, 0.0, 0])
+        p[0] += 1
+        p[1] += seconds
+        p[2] += count
+
+    def sample(self, name, seconds):
+        '''record a latency'''
+        self.latencies.setdefault(name, []).append(seconds)
+
+    def count(self, name, n=1):
+        '''increment a counter'''
+        self.counters[name] = self.counters.get(name, 0) + n
+
+    def timed(self, phase, function, size=None):
+        '''return function that records its time in a phase; size returns the
+           number of bytes processed from the arguments and result, by default
+           that of the first argument'''
+        def timedfunction(*args, **kwargs):
+            # time of the phases called by this one, by thread
+            running = self.nested.__dict__.setdefault('running', [])
+            running.append(0.0)
+            starttime = time.time()
+            result = None
+            try:
+                result = function(*args, **kwargs)
+                return result
+            finally:
+                elapsed = time.time() - starttime
+                nested = running.pop()
+                if running: running[-1] += elapsed
+                if size: count = size(args, result)
+                else: count = args and _size(args[0]) or 0
+                self.add(phase, elapsed - nested, count)
+        timedfunction.__name__ = function.__name__
+        timedfunction.__doc__ = function.__doc__
+        return timedfunction
+
+    def iterate(self, iterable, phase):
+        '''yield items of iterable, recording the time taken to get each one
+           and its length in a phase'''
+        item = self.timed(phase, iter(iterable).next, lambda args, item: len(item or ''))
+        while True:
+            yield item()
+
+    def file(self, f, read, write):
+        '''return file that records the time of reading and writing it'''
+        return _TimedFile(self, f, read, write)
+
+    def summary(self):
+        '''return statistics as a dict that can be stored as json'''
+        latencies = {}
+        for name, samples in self.latencies.items():
+            samples = sorted(samples)
+            histogram = [0]*(len(_buckets)+1)
+            for s in samples:
+                i = 0
+                while i < len(_buckets) and s*1000 >= _buckets[i]: i += 1
+                histogram[i] += 1
+            latencies[name] = {
+                'count': len(samples),
+                'min': samples[0], 'max': samples[-1],
+                'mean': sum(samples)/len(samples),
+                'median': samples[len(samples)/2],
+                'p90': samples[min(len(samples)*9/10, len(samples)-1)],
+                'histogram': histogram, 'buckets_ms': _buckets,
+            }
+        phases = {}
+        for name, (calls, seconds, count) in self.phases.items():
+            phases[name] = {'calls': calls, 'seconds': seconds, 'bytes': count}
+            if count: phases[name]['bytes_per_second'] = count/max(seconds, 1e-9)
+        return {'seconds': time.time() - self.starttime, 'phases': phases,
+                'latencies': latencies, 'counters': self.counters}
+
+    def report(self):
+        '''return statistics as text'''
+        s = self.summary()
+        lines = ['%-20s %8s %10s %10s %12s'%('phase', 'calls', 'time', 'bytes', 'rate')]
+        for name, p in sorted(s['phases'].items(), key=lambda i: -i[1]['seconds']):
+            rate = ''
+            if p['bytes']: rate = '%.1f kB/s'%(p['bytes_per_second']/1024)
+            lines.append('%-20s %8d %8.3f s %10d %12s'%(name, p['calls'], p['seconds'], p['bytes'], rate))
+        lines.append('%-20s %8s %8.3f s'%('total', '', s['seconds']))
+        for name, l in sorted(s['latencies'].items()):
+            lines.append('')
+            lines.append('%s: %d, min %.1f ms, median %.1f ms, 90%% %.1f ms, max %.1f ms'%(
+                name, l['count'], l['min']*1000, l['median']*1000, l['p90']*1000, l['max']*1000))
+            width = max(l['histogram'])
+            for i, n in enumerate(l['histogram']):
+                if not n: continue
+                if i < len(_buckets): bucket = '< %5d ms'%_buckets[i]
+                else: bucket = '>=%5d ms'%_buckets[-1]
+                lines.append('  %s %6d %s'%(bucket, n, '#'*max(n*40/width, 1)))
+        if s['counters']:
+            lines.append('')
+            for name, n in sorted(s['counters'].items()):
+                lines.append('%s: %d'%(name, n))
+        return '\n'.join(lines) + '\n'
+
+class _TimedFile(object):
+    '''File whose reads and writes are recorded in phases'''
+
+    def __init__(self, stats, f, read, write):
+        self._stats = stats
+        self._f = f
+        self._read = read
+        self._write = write
+
+    def read(self, *args):
+        return self._stats.timed(self._read, self._f.read, lambda args, data: len(data or ''))(*args)
+
+    def write(self, data):
+        return self._stats.timed(self._write, self._f.write)(data)
+
+    def __getattr__(self, name):
+        return getattr(self._f, name)
+
+def stats_enable():
+    '''start timing the codec functions; return Stats object'''
+    stats = Stats()
+    for phase, function in _phases:
+        timed = stats.timed(phase, function)
+        # replace it wherever it was imported, also in standalone scripts
+        for module in sys.modules.values():
+            if getattr(module, function.__name__, None) is function:
+                setattr(module, function.__name__, timed)
+    return stats
+
+def stats_output(stats, format, f=None):
+    '''write statistics in format 'text' or 'json' to f (default stderr)'''
+    f = f or sys.stderr
+    if format == 'json': f.write(json.dumps(stats.summary(), indent=1, sort_keys=True) + '\n')
+    elif format == 'text': f.write(stats.report())
+    else: raise BCFWException("unknown statistics format %s"%format)
@@ -0,0 +1,112 @@
+#
+#  Unofficial Behringer Control Development Kit - common helpers
+#
+#  Copyright (C) 2010 Willem van Engen <dev-bc2000@willem.engen.nl>
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License along
+#  with this program; if not, write to the Free Software Foundation, Inc.,
+#  51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+
+import sys, os, binascii, array
+
+# Bulk conversions use numpy when it is installed. Setting BCFW_BACKEND=python
+# in the environment selects the plain python implementation instead.
+numpy = None
+if os.environ.get('BCFW_BACKEND', 'numpy') == 'numpy':
+    try:
+        import numpy
+    except ImportError:
+        pass
+backend = numpy and 'numpy' or 'python'
+
+##############################################################################
+## General helper functions
+
+class BCFWException(Exception):
+    pass
+
+def wunpack(x):
+    '''convert array of 4 bytes to 32bit word'''
+    if len(x) < 4: raise BCFWException('Need 4 bytes or more to unpack')
+    return (x[3]<<24) + (x[2]<<16) + (x[1]<<8) + x[0]
+
+def wpack(x, offs=0):
+    '''convert 32bit word to array of bytes'''
+    return [ (x>> 0)&0xff, (x>> 8)&0xff, (x>>16)&0xff, (x>>24)&0xff ]
+
+wordtype = [ t for t in 'IL' if array.array(t).itemsize == 4 ][0]
+
+def bytes2words(x):
+    '''convert byte buffer to array of little-endian 32bit words'''
+    if len(x) % 4: raise BCFWException('Need a multiple of 4 bytes to unpack')
+    if numpy: return numpy.frombuffer(x, '<u4').astype(numpy.uint32)
+    out = array.array(wordtype, str(x))
+    if sys.byteorder == 'big': out.byteswap()
+    return out
+
+def words2bytes(x):
+    '''convert array of 32bit words to little-endian byte buffer'''
+    if numpy: return bytearray(x.astype('<u4').tostring())
+    out = array.array(wordtype, x)
+    if sys.byteorder == 'big': out.byteswap()
+    return bytearray(out.tostring())
+
+def array2str(x):
+    '''convert array of bytes to string'''
+    out = ''
+    for e in x: out += chr(e)
+    return out
+
+def str2array(x):
+    '''convert string to array of bytes'''
+    out = []
+    for e in x: out.append(ord(e))
+    return out
+
+def bytes2long(data):
+    '''convert byte buffer to big-endian long'''
+    return long(binascii.hexlify(data), 16)
+
+def long2bytes(x, length):
+    '''convert big-endian long to byte buffer of given length'''
+    return bytearray(binascii.unhexlify('%0*x'%(length*2, x)))
+
+def xorbytes(a, b):
+    '''return xor of two byte buffers of equal length'''
+    if not a: return bytearray()
+    if numpy:
+        a = numpy.frombuffer(a, numpy.uint8)
+        b = numpy.frombuffer(b, numpy.uint8)
+        return bytearray((a ^ b).tostring())
+    return long2bytes(bytes2long(a) ^ bytes2long(b), len(a))
+
+def cache_path(*names):
+    '''return path of a file or directory in the user's cache directory'''
+    base = os.environ.get('XDG_CACHE_HOME') or os.path.expanduser('~/.cache')
+    return os.path.join(base, 'bcfw', *names)
+
+def readchunks(f, size=0x4000):
+    '''yield chunks of data from a file, pipe or socket as soon as they arrive'''
+    if hasattr(f, 'recv'):
+        read = f.recv
+    else:
+        try:
+            fd = f.fileno()
+            read = lambda n: os.read(fd, n)
+        except (AttributeError, IOError, ValueError):
+            read = f.read
+    while True:
+        chunk = read(size)
+        if not chunk: break
+        yield chunk
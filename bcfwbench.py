@@ -0,0 +1,326 @@
+#!/usr/bin/env python
+#
+#  Unofficial Behringer Control Development Kit - benchmarks
+#
+#  Copyright (C) 2010 Willem van Engen <dev-bc2000@willem.engen.nl>
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License along
+#  with this program; if not, write to the Free Software Foundation, Inc.,
+#  51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+#
+# Times the codec stages, the conversions of bcfwconvert and transfers with an
+# emulated device on a synthetic full-size image, to find out whether a change
+# made things faster or slower. Each benchmark runs in a process of its own,
+# so that its peak memory use can be measured too.
+#
+
+import sys, getopt, os, time, json, random, resource, tempfile, shutil, subprocess, threading, traceback
+
+from bcfw.util import BCFWException, backend
+from bcfw.codec import syx_implode, syx_explode, syx_decode, syx_checksum, syx_checksum_update, syx_decode_write, syx2dump, dump2syx
+from bcfw.osimage import os2dump, dump2os
+from bcfw.emulator import Emulator, FlashChip
+from bcfw.midi import MidiPort
+from bcfw.flash import flash_upload, flash_read
+
+__AUTHOR__  = "Willem van Engen <dev-bc2000@willem.engen.nl>"
+__VERSION__ = "2010.08.27"
+__LICENSE__ = "GPL version 2 or higher"
+
+_usage = r"""
+bc benchmark tool version %s by %s
+Usage: bcfwbench [-b benchmark[,...]] [-n repeat] [-o out_file] [-c baseline] [-t percent] [-l] [-h]
+
+    -b    benchmarks to run (default: all)
+    -n    number of times to run each benchmark, the fastest run counts
+          (default: 3)
+    -o    name of file to store the results in as a baseline (json)
+    -c    compare with a baseline, failing when a benchmark is slower or
+          uses more memory than the threshold allows
+    -t    threshold in percent (default: 20)
+    -l    list benchmarks
+    -h    show this help
+"""[1:] % (__VERSION__, __AUTHOR__)
+
+# size of the synthetic os image; the largest that fits in flash
+_imagesize = 0x3c000
+
+##############################################################################
+## Benchmarks
+
+#
+# Each benchmark is a function that is given the directory with the input
+# files and returns a function to time together with the number of bytes it
+# processes, so that preparing the input is not counted.
+#
+
+def bench_implode(d):
+    data = syx_explode(_read(d, 'os')[:_imagesize/7*7])
+    return lambda: syx_implode(data), len(data)
+
+def bench_explode(d):
+    data = _read(d, 'os')[:_imagesize/7*7]
+    return lambda: syx_explode(data), len(data)
+
+def bench_decode(d):
+    data = _read(d, 'os')
+    return lambda: syx_decode(data), len(data)
+
+def bench_checksum(d):
+    data = _read(d, 'os')
+    return lambda: syx_checksum(data), len(data)
+
+def bench_checksum_update(d):
+    # this one goes bit by bit, so a part of the image is enough
+    data = _read(d, 'os')[:0x4000]
+    def run():
+        checksum = 0
+        for byte in data: checksum = syx_checksum_update(byte, checksum)
+    return run, len(data)
+
+def bench_decode_write(d):
+    data = _read(d, 'dump')
+    def run():
+        for sector in range(0, len(data), 0x1000):
+            syx_decode_write(data[sector:sector+0x1000], 2+sector/0x1000)
+    return run, len(data)
+
+def bench_os2dump(d):
+    data = _read(d, 'os')
+    return lambda: os2dump(data), len(data)
+
+def bench_dump2os(d):
+    data = _read(d, 'dump')
+    return lambda: dump2os(data), len(data)
+
+def bench_dump2syx(d):
+    data = _read(d, 'dump')
+    return lambda: dump2syx(data, 0x2000, 0x7f), len(data)
+
+def bench_syx2dump(d):
+    data = _read(d, 'syx')
+    return lambda: syx2dump(data), len(data)
+
+def _convert(informat, outformat):
+    '''return benchmark of a conversion by bcfwconvert'''
+    def bench(d):
+        script = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'bcfwconvert.py')
+        args = [sys.executable, script, '-i', os.path.join(d, informat), '-I', informat,
+                '-o', os.path.join(d, 'out'), '-O', outformat, '-f']
+        if outformat == 'syx': args += ['-b', '0x2000']
+        def run():
+            if subprocess.call(args, stderr=open(os.devnull, 'w')):
+                raise BCFWException("bcfwconvert failed converting %s to %s"%(informat, outformat))
+        return run, os.path.getsize(os.path.join(d, informat))
+    return bench
+
+def _transfer(upload):
+    '''return benchmark of an upload or retrieval of 64k with an emulated
+       device that takes no time itself'''
+    def bench(d):
+        data = _read(d, 'dump')[:0x10000]
+        syx = dump2syx(data, 0x2000, 0x15)
+        emulator = Emulator(chip=FlashChip(erasetime=0, programtime=0), latency=0)
+        thread = threading.Thread(target=emulator.serve)
+        thread.daemon = True
+        thread.start()
+        port = MidiPort(emulator.path)
+        quiet = lambda msg: None
+        if upload: return lambda: flash_upload(port, syx, log=quiet), len(data)
+        return lambda: flash_read(port, 0x2000, len(data), log=quiet), len(data)
+    return bench
+
+_benchmarks = [
+    ('implode', bench_implode),
+    ('explode', bench_explode),
+    ('decode', bench_decode),
+    ('checksum', bench_checksum),
+    ('checksum_update', bench_checksum_update),
+    ('decode_write', bench_decode_write),
+    ('os2dump', bench_os2dump),
+    ('dump2os', bench_dump2os),
+    ('dump2syx', bench_dump2syx),
+    ('syx2dump', bench_syx2dump),
+    ('convert_os_syx', _convert('os', 'syx')),
+    ('convert_syx_os', _convert('syx', 'os')),
+    ('convert_dump_syx', _convert('dump', 'syx')),
+    ('convert_syx_dump', _convert('syx', 'dump')),
+    ('convert_dump_os', _convert('dump', 'os')),
+    ('convert_os_dump', _convert('os', 'dump')),
+    ('upload', _transfer(True)),
+    ('retrieve', _transfer(False)),
+]
+
+def _read(d, name):
+    return bytearray(open(os.path.join(d, name), 'rb').read())
+
+def bench_inputs(d):
+    '''write the synthetic os image, and the dump and sysex file made from it,
+       to directory d'''
+    rnd = random.Random(0x2000)
+    image = bytearray([rnd.randrange(256) for i in range(_imagesize)])
+    dump = os2dump(image)
+    for name, data in [('os', image), ('dump', dump), ('syx', dump2syx(dump, 0x2000, 0x7f))]:
+        open(os.path.join(d, name), 'wb').write(data)
+
+##############################################################################
+## Running benchmarks
+
+def _child(function, *args):
+    '''run function in a child process; return its result and the peak
+       memory use of the process in kB'''
+    r, w = os.pipe()
+    pid = os.fork()
+    if not pid:
+        os.close(r)
+        # the code being measured may report progress
+        os.dup2(os.open(os.devnull, os.O_WRONLY), 2)
+        try:
+            result = {'result': function(*args)}
+        except:
+            result = {'error': traceback.format_exc().strip().split('\n')[-1]}
+        f = os.fdopen(w, 'w')
+        f.write(json.dumps(result))
+        f.close()
+        os._exit(0)
+    os.close(w)
+    f = os.fdopen(r)
+    result = json.loads(f.read() or '{"error": "benchmark process died"}')
+    f.close()
+    pid, status, rusage = os.wait4(pid, 0)
+    if 'error' in result: raise BCFWException(result['error'])
+    return result['result'], rusage.ru_maxrss
+
+def bench_run(name, d, repeat=3):
+    '''run a benchmark; return dict of its throughput and peak memory use'''
+    def run():
+        function, count = dict(_benchmarks)[name](d)
+        best = None
+        for i in range(repeat):
+            starttime = time.time()
+            function()
+            elapsed = time.time() - starttime
+            if best is None or elapsed < best: best = elapsed
+        # peak memory of bcfwconvert runs, which are not part of this process
+        children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+        return count, best, children
+    (count, elapsed, children), maxrss = _child(run)
+    return {'bytes': count, 'seconds': elapsed, 'mbps': count/1e6/max(elapsed, 1e-6),
+            'maxrss': max(maxrss, children)}
+
+def bench_compare(results, baseline, threshold):
+    '''return list of (benchmark, description) of the results that are worse
+       than the baseline by more than threshold percent'''
+    worse = []
+    for name, result in sorted(results.items()):
+        base = baseline.get('benchmarks', {}).get(name)
+        if not base: continue
+        if result['mbps'] < base['mbps']*(1 - threshold/100.0):
+            worse.append((name, '%.2f MB/s was %.2f MB/s'%(result['mbps'], base['mbps'])))
+        if result['maxrss'] > base['maxrss']*(1 + threshold/100.0):
+            worse.append((name, '%d kB was %d kB'%(result['maxrss'], base['maxrss'])))
+    return worse
+
+
+##############################################################################
+## Main program
+
+if __name__ == "__main__":
+  try:
+    #
+    # parse options
+    #
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], "b:n:o:c:t:lh")
+    except getopt.GetoptError:
+        sys.stderr.write(_usage)
+        sys.exit(1)
+
+    names        = [name for name, bench in _benchmarks]
+    repeat       = 3
+    outfile      = None
+    baselinefile = None
+    threshold    = 20.0
+
+    for o, a in opts:
+        if o == "-b":
+            names = a.split(',')
+        if o == "-n":
+            repeat = int(a, 0)
+        if o == "-o":
+            outfile = a
+        if o == "-c":
+            baselinefile = a
+        if o == "-t":
+            threshold = float(a)
+        if o == "-l":
+            for name, bench in _benchmarks: print name
+            sys.exit(0)
+        if o == "-h":
+            sys.stderr.write(_usage)
+            sys.exit(0)
+
+    #
+    # validate options
+    #
+    for name in names:
+        if not name in dict(_benchmarks):
+            sys.stderr.write("Unknown benchmark: %s\n" % name)
+            sys.exit(1)
+
+    baseline = None
+    if baselinefile:
+        try:
+            baseline = json.load(open(baselinefile))
+        except (EnvironmentError, ValueError):
+            raise BCFWException("Unable to read baseline %s.\n" % baselinefile)
+        if baseline.get('backend') != backend:
+            sys.stderr.write("warning: baseline was made with the %s backend, this is %s\n" % (baseline.get('backend'), backend))
+
+    #
+    # run benchmarks
+    #
+    d = tempfile.mkdtemp(prefix='bcfwbench')
+    try:
+        _child(bench_inputs, d)
+        results = {}
+        for name in names:
+            results[name] = bench_run(name, d, repeat)
+            line = '%-18s %9.2f MB/s %8d kB' % (name, results[name]['mbps'], results[name]['maxrss'])
+            base = baseline and baseline.get('benchmarks', {}).get(name)
+            if base: line += '  %+4.0f%%' % ((results[name]['mbps']/base['mbps'] - 1)*100)
+            print line
+            sys.stdout.flush()
+    finally:
+        shutil.rmtree(d)
+
+    if outfile:
+        try:
+            json.dump({'backend': backend, 'python': sys.version.split()[0], 'benchmarks': results},
+                      open(outfile, 'w'), indent=1, sort_keys=True)
+        except EnvironmentError:
+            raise BCFWException("Unable to write %s.\n" % outfile)
+
+    if baseline:
+        worse = bench_compare(results, baseline, threshold)
+        for name, description in worse:
+            sys.stderr.write("%s: %s\n" % (name, description))
+        if worse:
+            raise BCFWException("%d of %d benchmarks got worse by more than %g%%" % (len(worse), len(results), threshold))
+
+  except BCFWException, e:
+    sys.stderr.write(str(e)+'\n')
+    sys.exit(1)
+
+# vim:et:sw=4:ts=4:ai:
@@ -21,6 +21,14 @@
 
 import sys, getopt, os
 
+from bcfw.util import BCFWException, readchunks
+from bcfw.image import BinaryImage
+from bcfw.codec import syx2dump_stream, dump2syx
+from bcfw.osimage import dump2os, os2dump
+from bcfw.stats import stats_enable, stats_output
+from bcfw.batch import batch_model, batch_parse, batch_run
+from bcfw.convertcache import ConvertCache, convert_digest
+
 __AUTHOR__  = "Willem van Engen <dev-bc2000@willem.engen.nl>"
 __VERSION__ = "2010.08.25"
 __LICENSE__ = "GPL version 2 or higher"
@@ -28,7 +36,9 @@ __LICENSE__ = "GPL version 2 or higher"
 _usage = r"""
 bc firmware conversion tool version %s by %s
 Usage: bcfwconvert [-i in_file] [-I in_format] [-o out_file] [-O out_format] \
-                   [-h] [-f] [-s offset] [-b base_address] [-m model_id]
+                   [-h] [-f] [-s offset] [-b base_address] [-m model_id] \
+                   [--stats=format] [--cache|--no-cache]
+       bcfwconvert -M manifest [-j jobs] [-f] [--cache|--no-cache] [-h]
 
     -i    name of input file (default: standard input)
     -I    format of input file: syx, dump or os
@@ -38,293 +48,23 @@ Usage: bcfwconvert [-i in_file] [-I in_format] [-o out_file] [-O out_format] \
     -s    input image offset in bytes (default: 0)
     -b    base address (syx output)
     -m    model id (syx output, default: 0x7f which means any)
+    --stats=format
+          show where the time went afterwards, as text or json
+    -M    do the conversions listed in a manifest file (- for standard
+          input), one per line with the options above; each input is read
+          once and the outputs are written in parallel
+    -j    number of conversions to do at once (default: number of cpus)
+    --cache
+          keep outputs in the user's cache directory, and use them instead of
+          converting again when the same input is converted the same way;
+          the environment variable BCFW_CONVERT_CACHE turns this on as well
+          and sets its size in MB (default: 64)
+    --no-cache
+          do not use the cache, even when turned on by the environment
     -h    show this help
 """[1:] % (__VERSION__, __AUTHOR__)
 
 
-##############################################################################
-## General helper functions
-
-class BCFWException(Exception):
-    pass
-
-def wunpack(x):
-    '''convert array of 4 bytes to 32bit word'''
-    if len(x) < 4: raise BCFWException('Need 4 bytes or more to unpack')
-    return (x[3]<<24) + (x[2]<<16) + (x[1]<<8) + x[0]
-
-def wpack(x, offs=0):
-    '''convert 32bit word to array of bytes'''
-    return [ (x>> 0)&0xff, (x>> 8)&0xff, (x>>16)&0xff, (x>>24)&0xff ]
-
-def array2str(x):
-    '''convert array of bytes to string'''
-    out = ''
-    for e in x: out += chr(e)
-    return out
-
-def str2array(x):
-    '''convert string to array of bytes'''
-    out = []
-    for e in x: out.append(ord(e))
-    return out
-
-##############################################################################
-## Sysex handling
-
-def syx_implode(data):
-    '''convert 7bit data stream to 8bit;
-       each 8th byte contains high bits of preceding 7 inverted'''
-    if len(data) % 8:
-        raise BCFWException('length of sysex blob must be multiple of 8 but is 0x%x'%len(data))
-    out = [0] * (len(data)/8*7)
-    j = 0
-    for i in range(len(data)):
-        if i%8 == 7:
-            for k in range(7):
-                if data[i] & (1<<k): out[j-k-1] |= 0x80
-        else:
-            out[j] = data[i]
-            j += 1
-    return out
-
-def syx_explode(data):
-    '''convert 8bit array to 7bit by inserting a byte with the high bits
-    each 7 bytes'''
-    if len(data) % 7:
-        raise BCFWException('length of data to encode to sysex blob must be multiple of 7 but is 0x%x'%len(data))
-    j = 0
-    out = [0] * (len(data)/7*8)
-    highbits = 0
-    for byte in data:
-        if byte & 0x80: highbits |= 1<<(6-(j%8))
-        out[j] = byte & 0x7f
-        j += 1
-        if j%8 == 7:
-            out[j] = highbits
-            j += 1
-            highbits = 0
-    return out
-
-_syx_cipher= [ 0x54, 0x5a, 0x27, 0x30, 0x33, 0x42, 0x43, 0x4f, 0x4e, 0x54, 0x52, 0x4f, 0x4c ]
-def syx_decode(data):
-    '''return deciphered data; as it is xor it works both ways'''
-    out = [0] * len(data)
-    for i in range(len(data)):
-        out[i] = data[i] ^ _syx_cipher[i%len(_syx_cipher)]
-    return out
-
-def syx_checksum_update(byte, checksum):
-    '''return updated checksum for this byte'''
-    for i in range(8):
-        if not ((byte>>i)^checksum)&1: checksum ^= 0x19
-        if checksum&1: checksum |= 0x100
-        checksum >>= 1
-    return checksum
-
-def syx_decode_write(data, dmagic):
-    '''return (de)ciphered data that happens for writing only'''
-    out = []
-    if len(data)%2:
-        raise BCFWException("syx_decode_write: length must be divisible by two")
-    if not dmagic: dmagic = 0x545a
-    for i in range(0,len(data),2):
-        if dmagic & 1: dmagic ^= 0x8005
-        dmagic >>= 1
-        out.append(data[i] ^ (dmagic&0xff))
-        out.append(data[i+1] ^ ((dmagic>>8)&0xff))
-    return out
-
-## Behringer firmware sysex message
-#
-#    | Manu ID  | Dev+Mod | Cmd | Data               |
-# F0 | 00 20 32 | 00 15   |  34 | 00 01 02 03 04 ... |  F7  (hex)
-#  0 |  1  2  3 |  4  5   |   6 | 7..303             | 304  (dec)
-#
-# Data is decoded with 7to8 shuffling and cipher
-# Then the resulting data is interpreted as follows:
-#
-# Address | Checksum | Firmware page
-#  xx xx  |  y       | f0 f1 f2 f3 ...  (hex)
-#   0  1  |  2       | 3..258           (dec)
-#
-# checksum is computed over firmware page (3..258)
-
-_offs=0
-def syx_parse_packet(idata, lastaddr):
-    '''process a single chunk of firmware packet data.
-       If the argument doFlashDecipher is True, then also do the deciphering
-       that happens only when writing but not when reading from the device.'''
-    global _offs # hack
-    if len(idata) != 296:
-        raise BCFWException("wrong length: 0x%x should be 0x%x"%(len(idata),296))
-    odata = syx_decode(syx_implode(idata))
-    address = ( (odata[0]<<7) + odata[1] ) * 0x100
-    origsum = odata[2]
-    odata = odata[3:]
-    # make sure address is right
-    if lastaddr and address!=lastaddr+0x100:
-        raise BCFWException("No jump in firmware addresses allowed: 0x%05x->0x%05x"%(lastaddr,address))
-        #sys.stderr.write('New address 0x%05x at offset 0x%06x\n'%(address<<8, _offs))
-    _offs+=0x100
-    # and verify checksum
-    checksum = 0
-    for b in odata: checksum = syx_checksum_update(b, checksum)
-    if checksum != origsum:
-        raise BCFWException("Checksum error: 0x%x should be 0x%x"%(checksum,odata[2]))
-    return odata, address
-
-def syx2dump(idata):
-    '''convert a sysex file to a memory dump'''
-    odata = []
-    sysex = []
-    insysex = False
-    foundnonsysex = False
-    addr = [None, None]
-    command = None
-    for byte in idata:
-        if insysex or byte == 0xf0:
-            sysex.append(byte)
-        # handle sysex start
-        if byte == 0xf0:
-            insysex = True
-            continue
-        # handle and process sysex
-        elif byte == 0xf7:
-            insysex = False
-            # need behringer packet, firmware command
-            if sysex[1:4] == [0x00, 0x20, 0x32] and sysex[6] in [0x34, 0x74]:
-                # make sure we have one packet type: firmware image (0x34) or flash dump (0x74)
-                if not command: command = sysex[6]
-                if sysex[6] != command:
-                    raise BCFWException('Cannot parse both firmware image and flash dump packets at once')
-                # parse packet
-                data, addr[1] = syx_parse_packet(sysex[7:-1], addr[1])
-                odata.extend(data)
-                if addr[0] == None:
-                    addr[0] = addr[1]
-                    sys.stderr.write('Starting address: 0x%05x\n'%(addr[0]))
-                sysex = []
-                continue
-            sysex = []
-        # sysex data
-        elif insysex:
-            continue
-        # non-firmware packet, warn once
-        if not foundnonsysex:
-            sys.stderr.write("warning: non-firmware data present in input (mentioning once) 0x%2x\n"%byte)
-            foundnonsysex = True
-    # now do extra deciphering if it is a firmware dump to be written to device
-    if command == 0x34:
-        # TODO also handle non-4k-aligned
-        for i in range(0, len(odata), 0x1000):
-            odata[i:i+0x1000] = syx_decode_write(odata[i:i+0x1000], (i+addr[0])/0x1000)
-    return odata
-
-
-def dump2syx(idata, base, model):
-    '''convert a memory dump to a sysex file'''
-    if base & 0xfff:
-        raise BCFWException("base must be a multiple of 0x1000")
-    odata = []
-    header = [0xf0, 0x00, 0x20, 0x32, 0x7f, model, 0x34 ]
-    footer = [0xf7]
-    if base < 0x2000:
-        raise BCFWException("base address must be 0x2000 or more, or it may brick the device")
-    # make length a multiple of 4k
-    idata = idata + [0] * ((0x1000 - (len(idata)%0x1000))%0x1000)
-    # flash in 0x1000=4k byte sectors
-    for page in range(0, len(idata), 0x1000):
-        sector = syx_decode_write(idata[page:page+0x1000], (base+page)/0x1000)
-        # packet size of 0x100
-        for subpage in range(0, 0x1000, 0x100):
-            # construct argument to firmware upload command
-            arg = [0] * 0x103
-            arg[0] = ((base+page+subpage)/0x100) >> 8
-            arg[1] = ((base+page+subpage)/0x100) & 0xff
-            arg[3:0x103] = sector[subpage:subpage+0x100]
-            # compute checksum
-            for b in arg[3:]: arg[2] = syx_checksum_update(b, arg[2])
-            # and output sysex packet
-            odata.extend(header + syx_explode(syx_decode(arg)) + footer)
-    return odata
-
-##############################################################################
-## OS image handling
-
-_oscipher1 = [ 0x2726534c, 0x3971212d, 0x71167b24, 0x69272171, 0x3b652f24,
-               0x30293644, 0x541a183f, 0x2c3f7c31, 0x29287d28, 0x5648553d,
-               0x4c4f1257, 0x31677518, 0x2e2e186a, 0x00554400, 0x44554d4d ]
-
-_oscipher2 = [ 0x75697361, 0x77386664, 0x33363765, 0x20756934, 0x6920686a,
-               0x74667564, 0x7437387a, 0x756f3372, 0x616f347a, 0x667a7569,
-               0x616f2067, 0x74203738, 0x747a3738, 0x00756920 ]
-
-def os_decodeword(wordin, offset):
-    '''encode/decode a 32bit word of data with cipher offset'''
-    return wordin \
-        ^ _oscipher1[offset % len(_oscipher1)] \
-        ^ _oscipher2[offset % len(_oscipher2)]
-
-def dump2os(idata):
-    '''convert a dump of the os flash to an os image'''
-    # first two words are special
-    size = os_decodeword(wunpack(idata[0:4]), 0)
-    #size = len(idata)-8
-    origsum = os_decodeword(wunpack(idata[4:8]), 1)
-    #sys.stderr.write("header: size=0x%x, checksum=0x%x\n"%(size, origsum))
-    # make sure size matches
-    if size <= 0 or ((size+3)/4)*4+0x2008 > 0x7ffff:
-        raise BCFWException("Bad size field: 0x%x must be between 0 and 0x%x"%(size, 0x7ffff-0x2008));
-    # and process the data
-    odata = [0] * size
-    dmagic = 0x42474552
-    checksum = 0
-    for offset in range(8, size+8, 4):
-        # deobfuscate
-        word = wunpack(idata[offset:offset+4])
-        word = os_decodeword(word, offset/4)
-        odata[offset-8:offset-8+4]=wpack(word)
-        # and update checksum
-        if dmagic & 1: dmagic |= 1<<32
-        dmagic >>= 1
-        checksum += dmagic ^ word
-    # verify checksum
-    checksum &= 0xffffffff
-    if checksum != origsum:
-        raise BCFWException("Corrupt image: checksum mismatch 0x%x should be 0x%x"%(checksum, origsum))
-    return odata
-
-def os2dump(idata):
-    '''convert an os image to a flashdump portion'''
-    size = len(idata)
-    # length validation and checksum
-    if size <= 0 or ((size+3)/4)*4+0x2008 > 0x7ffff:
-        raise BCFWException("Bad size: 0x%x must be between 0 and 0x%x"%(size, 0x7ffff-0x2008));
-    # fill 4k page with 0xff as official firmware does
-    #idata = idata + [0] * (4-(len(idata)%4))
-    idata = idata + [0xff] * ((0x1000 - ((size+8)%0x1000))%0x1000)
-    odata = [0] * (size+8)
-    odata[0:4] = wpack(os_decodeword(size, 0))
-    # and process the data
-    dmagic = 0x42474552
-    checksum = 0
-    for offset in range(0, len(idata), 4):
-        # obfuscate
-        word = wunpack(idata[offset:offset+4])
-        newword = os_decodeword(word, offset/4+2)
-        odata[offset+8:offset+8+4]=wpack(newword)
-        # and compute checksum (but not for filler bytes)
-        if offset < size:
-            if dmagic & 1: dmagic |= 1<<32
-            dmagic >>= 1
-            checksum += dmagic ^ word
-    # store checksum
-    checksum &= 0xffffffff
-    odata[4:8] = wpack(os_decodeword(checksum, 1))
-    return odata
-
-
 ##############################################################################
 ## Main program
 
@@ -334,7 +74,7 @@ if __name__ == "__main__":
     # parse options
     #
     try:
-        opts, args = getopt.getopt(sys.argv[1:], "i:o:I:O:s:b:m:hf")
+        opts, args = getopt.getopt(sys.argv[1:], "i:o:I:O:s:b:m:hfM:j:", ["stats=", "cache", "no-cache"])
     except getopt.GetoptError:
         sys.stderr.write(_usage)
         sys.exit(1)
@@ -350,6 +90,12 @@ if __name__ == "__main__":
     model           = 0x7f
     force_overwrite = False
     param_given     = False
+    statsformat     = None
+    stats           = None
+    manifest        = None
+    jobs            = None
+    usecache        = bool(os.environ.get('BCFW_CONVERT_CACHE'))
+    cache           = None
 
     for o, a in opts:
         param_given = True
@@ -366,15 +112,22 @@ if __name__ == "__main__":
         if o == "-b":
             baseaddress = int(a, 0)
         if o == "-m":
-            if a == "any": model = 0x7f
-            elif a.lower() == "bcf2000": model = 0x14
-            elif a.lower() == "bcr2000": model = 0x15
-            else: model = int(a, 0)
+            model = batch_model(a)
         if o == "-h":
             sys.stderr.write(_usage)
             sys.exit(0)
         if o == "-f":
             force_overwrite = True
+        if o == "--stats":
+            statsformat = a
+        if o == "-M":
+            manifest = a
+        if o == "-j":
+            jobs = int(a, 0)
+        if o == "--cache":
+            usecache = True
+        if o == "--no-cache":
+            usecache = False
 
     #
     # validate options
@@ -383,6 +136,28 @@ if __name__ == "__main__":
         sys.stderr.write(_usage)
         sys.exit(1)
 
+    if usecache:
+        try:
+            cache = ConvertCache(maxsize=int(os.environ.get('BCFW_CONVERT_CACHE') or 64)<<20)
+        except ValueError:
+            sys.stderr.write("BCFW_CONVERT_CACHE must be the size of the cache in MB\n")
+            sys.exit(1)
+
+    if manifest:
+        try:
+            if manifest == '-': lines = sys.stdin.readlines()
+            else: lines = open(manifest).readlines()
+        except EnvironmentError:
+            raise BCFWException("Unable to open %s." % manifest)
+        conversions = batch_parse(lines)
+        errors = batch_run(conversions, jobs, force_overwrite, cache)
+        for c, error in zip(conversions, errors):
+            if error: sys.stderr.write("%s: %s\n" % (c['outfile'], error))
+        failed = len([e for e in errors if e])
+        if failed:
+            raise BCFWException("%d of %d conversions failed" % (failed, len(conversions)))
+        sys.exit(0)
+
     if not informat and not outformat:
         sys.stderr.write("Please specify an input or output file format or both\n")
         sys.exit(1)
@@ -401,6 +176,13 @@ if __name__ == "__main__":
         sys.stderr.write("Unrecognised output file format: %s\n"%(outformat))
         sys.exit(1)
 
+    if statsformat and not statsformat in ["text", "json"]:
+        sys.stderr.write("Unrecognised statistics format: %s\n"%(statsformat))
+        sys.exit(1)
+
+    if informat == "os" and outformat == "syx" and baseaddress == None:
+        baseaddress = 0x2000
+
 
     #
     # open files
@@ -417,51 +199,88 @@ if __name__ == "__main__":
             sys.stderr.write("Output file %s exists.\n" % outfile)
             sys.exit(1)
         try:
-            outf = open(outfile, 'w')
+            outf = open(outfile, 'wb')
         except:
             sys.stderr.write("Unable to open %s.\n" % outfile)
             sys.exit(1)
 
+    if statsformat:
+        stats = stats_enable()
+        rawinf = inf
+        inf = stats.file(inf, 'read', 'write')
+        outf = stats.file(outf, 'read', 'write')
+
+    #
+    # use output of an earlier conversion of the same input when cached
+    #
+    key = None
+    if cache:
+        indata = inf.read()
+        key = cache.key(convert_digest(indata), informat, outformat, offset, baseaddress, model)
+        data = cache.get(key)
+        if data is not None:
+            outf.write(data)
+            outf.close()
+            if stats: stats_output(stats, statsformat)
+            sys.exit(0)
+
     #
     # do conversion
     #
-    data = str2array(inf.read())
+    if key and informat == "syx":
+        chunks = [indata]
+    elif key:
+        data = buffer(indata, offset or 0)
+    elif informat == "syx":
+        chunks = readchunks(inf)
+        if stats: chunks = stats.iterate(chunks, 'read')
+    elif stats:
+        # a mapped image is read as its pages are first used, which would be
+        # counted in the conversion steps; read it in at once instead
+        data = stats.timed('read', lambda f: bytearray(BinaryImage(f)[offset or 0:]), lambda args, data: len(data))(rawinf)
+    else:
+        # input image is mapped, the offset just moves the view
+        data = BinaryImage(inf)[offset or 0:]
+
     if informat == "os" and outformat == "dump":
-        if offset: data = data[offset:]
         data = os2dump(data)
         sys.stderr.write("note that the output file has base address 0x2000\n");
 
     elif informat == "dump" and outformat == "os":
-        if offset: data = data[offset:]
         data = dump2os(data)
 
     elif informat == "syx" and outformat == "dump":
         if not offset == None:
             sys.stderr.write("warning: offset is ignored for this conversion\n");
-        data = syx2dump(data)
+        # write out each sector as soon as it is complete
+        data = syx2dump_stream(chunks)
 
     elif informat == "syx" and outformat == "os":
-        data = syx2dump(data)
+        data = bytearray().join(syx2dump_stream(chunks))
         if offset: data = data[offset:]
         data = dump2os(data)
 
     elif informat == "dump" and outformat == "syx":
-        if offset: data = data[offset:]
         if not baseaddress:
             sys.stderr.write("need to specify base address\n")
             sys.exit(1)
         data = dump2syx(data, baseaddress, model)
 
     elif informat == "os" and outformat == "syx":
-        if offset: data = data[offset:]
-        if baseaddress == None: baseaddress = 0x2000
         data = os2dump(data)
         data = dump2syx(data, baseaddress, model)
 
     else:
         raise BCFWException("unimplemented conversion: %s to %s"%(informat,outformat))
 
-    outf.write(array2str(data))
+    if isinstance(data, bytearray): data = [data]
+    if key:
+        data = [bytearray().join(data)]
+        cache.put(key, str(data[0]))
+    for block in data: outf.write(block)
+    outf.close()
+
+    if stats: stats_output(stats, statsformat)
 
   except BCFWException, e:
     sys.stderr.write(str(e)+'\n')
@@ -0,0 +1,173 @@
+#!/usr/bin/env python
+#
+#  Unofficial Behringer Control Development Kit - device emulator
+#
+#  Copyright (C) 2010 Willem van Engen <dev-bc2000@willem.engen.nl>
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License along
+#  with this program; if not, write to the Free Software Foundation, Inc.,
+#  51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+#
+# Emulates devices in bootloader mode on pseudo terminals, so that bcfwflash
+# can be tried without a device attached.
+#
+
+import sys, getopt, threading, time
+
+from bcfw.util import BCFWException
+from bcfw.midi import midi_linkrates
+from bcfw.emulator import Emulator, FlashChip
+
+__AUTHOR__  = "Willem van Engen <dev-bc2000@willem.engen.nl>"
+__VERSION__ = "2010.08.27"
+__LICENSE__ = "GPL version 2 or higher"
+
+_usage = r"""
+bc device emulator version %s by %s
+Usage: bcfwemu [-m model] [-V version] [-i in_file] [-o out_file] [-n count] [-L link] [-t latency] [-e erase_time] [-w write_time] [-p bits] [-h]
+
+    -m    model to emulate: bcf2000 or bcr2000 (default: bcr2000)
+    -V    firmware version to report (default: 1.10)
+    -i    flash image to start with (default: erased flash)
+    -o    file to write the flash image to when done
+    -n    number of devices to emulate (default: 1)
+    -L    link to emulate: usb or din (default: usb)
+    -t    time in ms before the device answers a request (default: 1)
+    -e    time in ms to erase a 4k sector (default: 18)
+    -w    time in us to write a byte (default: 14)
+    -p    bits in each half of the page number of page replies: 7 or 8
+          (default: 7)
+    -h    show this help
+
+The name of each emulated midi device is printed, followed by a line to
+paste into the shell so that the devices are auto-detected. Devices are
+emulated until interrupted.
+"""[1:] % (__VERSION__, __AUTHOR__)
+
+
+##############################################################################
+## Main program
+
+if __name__ == "__main__":
+  try:
+    #
+    # parse options
+    #
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], "m:V:i:o:n:L:t:e:w:p:h")
+    except getopt.GetoptError:
+        sys.stderr.write(_usage)
+        sys.exit(1)
+
+    model     = 0x15
+    version   = '1.10'
+    infile    = None
+    outfile   = None
+    count     = 1
+    link      = 'usb'
+    latency   = 0.001
+    erasetime = 0.018
+    writetime = 14e-6
+    pagebits  = 7
+
+    for o, a in opts:
+        if o == "-m":
+            if a.lower() == "bcf2000": model = 0x14
+            elif a.lower() == "bcr2000": model = 0x15
+            else:
+                sys.stderr.write("please choose bcf2000 or bcr2000 as model\n")
+                sys.exit(1)
+        if o == "-V":
+            version = a
+        if o == "-i":
+            infile = a
+        if o == "-o":
+            outfile = a
+        if o == "-n":
+            count = int(a, 0)
+        if o == "-L":
+            link = a
+        if o == "-t":
+            latency = float(a)/1000
+        if o == "-e":
+            erasetime = float(a)/1000
+        if o == "-w":
+            writetime = float(a)/1000000
+        if o == "-p":
+            pagebits = int(a)
+        if o == "-h":
+            sys.stderr.write(_usage)
+            sys.exit(0)
+
+    #
+    # validate options
+    #
+    if not link in midi_linkrates:
+        sys.stderr.write("please choose usb or din as link (-L)\n")
+        sys.exit(1)
+
+    if not pagebits in [7, 8]:
+        sys.stderr.write("please choose 7 or 8 as page number bits (-p)\n")
+        sys.exit(1)
+
+    if outfile and count != 1:
+        sys.stderr.write("the flash image can be written for a single device only\n")
+        sys.exit(1)
+
+    image = None
+    if infile:
+        try:
+            image = bytearray(open(infile, 'rb').read())
+        except:
+            raise BCFWException("Unable to open %s.\n" % infile)
+        if len(image) > FlashChip.size:
+            raise BCFWException("Flash image %s is larger than 0x%x bytes.\n" % (infile, FlashChip.size))
+
+    #
+    # emulate devices until interrupted
+    #
+    devices = []
+    for i in range(count):
+        chip = FlashChip(image, erasetime, writetime)
+        devices.append(Emulator(model, version, chip, midi_linkrates[link], latency, pagebits=pagebits))
+    for device in devices:
+        print device.path
+    print 'export BCFW_MIDI_DEVICES=%s' % ':'.join([d.path for d in devices])
+    sys.stdout.flush()
+
+    threads = [threading.Thread(target=d.serve) for d in devices]
+    for t in threads:
+        t.daemon = True
+        t.start()
+    try:
+        while True: time.sleep(1)
+    except KeyboardInterrupt:
+        pass
+    for device in devices:
+        device.close()
+    # let them stop before the interpreter goes away under them
+    for t in threads:
+        t.join(1)
+
+    if outfile:
+        try:
+            open(outfile, 'wb').write(devices[0].chip.data)
+        except:
+            raise BCFWException("Unable to write %s.\n" % outfile)
+
+  except BCFWException, e:
+    sys.stderr.write(str(e)+'\n')
+    sys.exit(1)
+
+# vim:et:sw=4:ts=4:ai:
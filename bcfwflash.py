@@ -23,7 +23,14 @@
 # so I guess that means Linux/Unix only
 #
 
-import sys, getopt, os, glob, select
+import sys, getopt, os, hashlib
+
+from bcfw.util import BCFWException, array2str
+from bcfw.midi import midi_detect, midi_probe, MidiPort
+from bcfw.flashcache import FlashCache, flash_cache_name
+from bcfw.journal import journal_open
+from bcfw.stats import stats_enable, stats_output
+from bcfw.flash import flash_sectors, flash_resume, flash_changed, flash_upload_sectors, flash_unwritten, flash_upload_verify, flash_fleet, flash_get, flash_link, send_display
 
 __AUTHOR__  = "Willem van Engen <dev-bc2000@willem.engen.nl>"
 __VERSION__ = "2010.08.27"
@@ -31,15 +38,32 @@ __LICENSE__ = "GPL version 2 or higher"
 
 _usage = r"""
 bc firmware flash tool version %s by %s
-Usage: bcfwflash -u [-i in_file] [-d midi_device] [-h] [-r]
-       bcfwflash -g [-s range] [-o out_file] [-d midi_device] [-f] [-h] [-r]
-       bcfwflash -p <string> [-h]
+Usage: bcfwflash -u [-i in_file] [-w window] [-c] [-v|--verify] [-n] [--resume] [-L link] [--stats=format] [-d midi_device[,...] | -a] [-h] [-r]
+       bcfwflash -g [-s range] [-o out_file] [-w window] [-n] [--resume] [-L link] [--stats=format] [-d midi_device] [-f] [-h] [-r]
+       bcfwflash -p <string> [-L link] [-h]
        bcfwflash -r [-h]
        bcfwflash -l [-h]
 
     -u    upload firmware to the device
     -i    name of sysex input file (default: standard input)
-    -d    midi device to work on (default: auto-detect)
+    -w    number of 4k sectors to send ahead of acknowledgement when
+          uploading (default: 2), or of pages to request ahead when
+          retrieving (default: 4); use 1 to wait for each one
+    -c    only upload sectors that differ from what is in flash (the first
+          sector of the os image is always written); what is in flash is
+          taken from the flash cache when a few sample pages match
+    -v, --verify
+          verify upload by reading back the written sectors, and write the
+          sectors that differ again
+    -a    upload to all auto-detected devices at once
+    -d    midi device to work on (default: auto-detect); for upload a comma
+          separated list of devices may be given to flash them all at once
+    -L    link to the device: usb, din (physical midi ports, as needed for
+          rescue mode) or auto to tell them apart by measuring a transfer
+          (default: usb); sending is slowed down to what din midi can carry
+    --stats=format
+          show where the time went afterwards, as text or json: time spent
+          per phase, the latency of sectors and pages, and retries
 
     -r    reboot device after everything else
 
@@ -50,231 +74,16 @@ Usage: bcfwflash -u [-i in_file] [-d midi_device] [-h] [-r]
 
     -p    put a 4-character string on the device's display
 
+    -n    do not use or update the cache of each device's flash contents
+    --resume
+          continue an upload or retrieval that was interrupted, skipping the
+          sectors or pages that were completed already
+
     -l    list auto-detected midi devices
     -h    show this help
 """[1:] % (__VERSION__, __AUTHOR__)
 
 
-##############################################################################
-## General helper functions
-
-class BCFWException(Exception):
-    pass
-
-def array2str(x):
-    '''convert array of bytes to string'''
-    out = ''
-    for e in x: out += chr(e)
-    return out
-
-def str2array(x):
-    '''convert string to array of bytes'''
-    out = []
-    for e in x: out.append(ord(e))
-    return out
-
-def midi_receive_sysex(f, timeout=0.2):
-    '''return next sysex message from device, or None if timeout'''
-    sysex = []
-    insysex = False
-    while len(sysex)==0 or insysex:
-        if not f.fileno() in select.select([f.fileno()],[],[],timeout)[0]:
-            return None
-        byte = f.read(1)
-        c = ord(byte)
-        if c == 0xf0:
-            sysex = [c]
-            insysex = True
-        elif c == 0xf7:
-            sysex += [c]
-            insysex = False
-        else:
-            if insysex: sysex.append(c)
-    return sysex
-
-def midi_check_sysex(sysex, cmds, exceptions = True):
-    '''check if the response was a valid sysex blob message and return command'''
-    try:
-        if not sysex:
-            raise BCFWException("timeout waiting for flash blob from device")
-        if not sysex[1:4] == [0x00, 0x20, 0x32]:
-            raise BCFWException("unexpected sysex manufacturer received: 0x%02x,0x%02x,0x%02x"%(sysex[1],sysex[2],sysex[3]))
-        if not sysex[6] in cmds:
-            raise BCFWException("unexpected sysex response command received: 0x%02x"%sysex[6])
-        return sysex[6]
-    except BCFWException, e:
-        if not exceptions: return None
-        raise e
-
-def midi_detect(verbose=False, findall=False):
-    '''detect midi devices that have a Behringer Control device attached'''
-    if os.path.isdir("/dev/snd"):
-        devices = glob.glob("/dev/snd/midi*")
-    else:
-        devices = glob.glob("/dev/midi*")
-    if not devices:
-        raise BCFWException("No midi devices found")
-    # find matching id responses on each device
-    founddevnames = []
-    for devname in devices:
-        try:
-            devf = open(devname, 'r+b', 0)
-        except:
-            if verbose: sys.stderr.write("warning: could not open midi device %s\n"%devname)
-            continue
-        data = [0xf0, 0x00, 0x20, 0x32, 0x7f, 0x7f, 0x01, 0xf7]
-        devf.write(array2str(data))
-        devf.flush()
-        recvd = midi_receive_sysex(devf,1)
-        devf.close()
-        if recvd and recvd[0:4] == [0xf0, 0x00, 0x20, 0x32]:
-            if verbose: sys.stderr.write("%s:\t%s\n"%(devname, array2str(recvd[7:-1])))
-            if not findall: return devname
-            founddevnames.append(devname)
-    if not findall: return None
-    return founddevnames
-
-
-##############################################################################
-## Flash upload functions
-
-def flash_upload(f, data):
-    '''Upload sysex firmware data to the device'''
-    offset = 0
-    nonsysexwarned = False
-    while offset < len(data):
-        # start of current message
-        curoffset = offset
-        if data[offset] != 0xf0:
-            if not nonsysexwarned:
-                sys.stderr.write('warning: found non-sysex data (mentioning only once)\n')
-                nonsysexwarned = True
-            offset += data[offset:].index(0xf0)
-        # end of current message
-        offset += data[offset:].index(0xf7) + 1
-        # now send current message
-        f.write(array2str(data[curoffset:offset]))
-        f.flush()
-        # wait for response if on 4k boundary
-        argstart = syx_decode(syx_implode(data[curoffset+7:curoffset+7+8]))
-        address = (argstart[0]<<8) + argstart[1]
-        if address % 0x10 == 0x0f:
-            # and parse response, if any; handle loopback too
-            sysex = midi_receive_sysex(f,4)
-            while midi_check_sysex(sysex, [0x34, 0x35], False) == 0x34:
-                sysex = midi_receive_sysex(f,4)
-            # parse response packet
-            midi_check_sysex(sysex, [0x35])
-            address = ((sysex[7]<<7) + sysex[8])*0x100
-            status = 'ok\r'
-            if sysex[9] == 1: status = 'sector incomplete\n'
-            if sysex[9] == 2: status = 'erase failure\n'
-            if sysex[9] == 3: status = 'write failure\n'
-            sys.stderr.write('0x%06x-0x%06x: %s'%(address-0xf00,address+0x100,status))
-
-##############################################################################
-## Flash retrieval functions
-
-def flash_get_blob(f, page):
-    '''request flash blob from midi device by page'''
-    # sysex message to request flash
-    data = [0xf0, 0x00, 0x20, 0x32, 0x7f, 0x7f, 0x74, page>>7, page&0x7f, 0xf7]
-    f.write(array2str(data))
-    f.flush()
-    # receive dump, but allow for sending the packet back
-    sysex = midi_receive_sysex(f)
-    while midi_check_sysex(sysex, [0x34, 0x74], False) == 0x74:
-        sysex = midi_receive_sysex(f)
-    midi_check_sysex(sysex, [0x34])
-    # change command to avoid bricking device when writing it back accidentally
-    sysex[6] = 0x74
-    return sysex
-
-def flash_get(f, addr, count):
-    '''request flash address range from midi device.'''
-    if addr&0xff: raise BCFWException('Start address must be a multiple of 0x100')
-    if count&0xff: raise BCFWException('Count must be a multiple of 0x100')
-    data = []
-    # first get all blobs required
-    for curaddr in range(addr, addr+count, 0x100):
-        sys.stderr.write('0x%06x-0x%06x\r'%(curaddr,curaddr+0x100))
-        data += flash_get_blob(f, curaddr/0x100)
-    return data
-
-##############################################################################
-## Special feature functions
-
-# sorry for the code duplication from bcfwconvert; but this makes it easy
-# to just take the script as it is without caring for dependencies
-
-def syx_implode(data):
-    '''convert 7bit data stream to 8bit;
-       each 8th byte contains high bits of preceding 7 inverted'''
-    if len(data) % 8:
-        raise BCFWException('length of sysex blob must be multiple of 8 but is 0x%x'%len(data))
-    out = [0] * (len(data)/8*7)
-    j = 0
-    for i in range(len(data)):
-        if i%8 == 7:
-            for k in range(7):
-                if data[i] & (1<<k): out[j-k-1] |= 0x80
-        else:
-            out[j] = data[i]
-            j += 1
-    return out
-
-def syx_explode(data):
-    '''convert 8bit array to 7bit by inserting a byte with the high bits
-    each 7 bytes'''
-    if len(data) % 7:
-        raise BCFWException('length of data to encode to sysex blob must be multiple of 7 but is 0x%x'%len(data))
-    j = 0
-    out = [0] * (len(data)/7*8)
-    highbits = 0
-    for byte in data:
-        if byte & 0x80: highbits |= 1<<(6-(j%8))
-        out[j] = byte & 0x7f
-        j += 1
-        if j%8 == 7:
-            out[j] = highbits
-            j += 1
-            highbits = 0
-    return out
-
-_syx_cipher= [ 0x54, 0x5a, 0x27, 0x30, 0x33, 0x42, 0x43, 0x4f, 0x4e, 0x54, 0x52, 0x4f, 0x4c ]
-def syx_decode(data):
-    '''return deciphered data; as it is xor it works both ways'''
-    out = [0] * len(data)
-    for i in range(len(data)):
-        out[i] = data[i] ^ _syx_cipher[i%len(_syx_cipher)]
-    return out
-
-def syx_checksum_update(byte, checksum):
-    '''return updated checksum for this byte'''
-    for i in range(8):
-        if not ((byte>>i)^checksum)&1: checksum ^= 0x19
-        if checksum&1: checksum |= 0x100
-        checksum >>= 1
-    return checksum
-
-def send_display(f, s):
-    '''Send a 4-character string to the display. If the string is "boot" the
-    device will reboot.'''
-    # construct packet argument
-    arg  = [0xff, 0x00]             # special address
-    arg += [0x00]                   # checksum (compute later)
-    arg += str2array(s[0:4])        # string
-    arg += [0]*(0x100-4)            # padding
-    for i in arg[3:]: arg[2] = syx_checksum_update(i, arg[2])
-    # construct packet
-    data  = [0xf0, 0x00, 0x20, 0x32, 0x7f, 0x7f, 0x34] # firmware send packet
-    data += syx_explode(syx_decode(arg))
-    data += [0xf7]                  # end of sysex
-    # checksum
-    f.write(array2str(data))
-    f.flush()
-
-
 ##############################################################################
 ## Main program
 
@@ -284,7 +93,7 @@ if __name__ == "__main__":
     # parse options
     #
     try:
-        opts, args = getopt.getopt(sys.argv[1:], "ugli:o:d:s:p:hrf")
+        opts, args = getopt.getopt(sys.argv[1:], "ugli:o:d:s:p:w:hrfavcnL:", ["verify", "resume", "stats="])
     except getopt.GetoptError:
         sys.stderr.write(_usage)
         sys.exit(1)
@@ -300,6 +109,15 @@ if __name__ == "__main__":
     force_overwrite = False
     param_given     = False
     display         = None
+    window          = None
+    verify          = False
+    changedonly     = False
+    usecache        = True
+    resume          = False
+    alldevices      = False
+    link            = 'usb'
+    statsformat     = None
+    stats           = None
 
     for o, a in opts:
         param_given = True
@@ -311,6 +129,8 @@ if __name__ == "__main__":
             midifile = a
         if o == "-s":
             arange = map(lambda x: int(x,0), a.split('-'))
+        if o == "-w":
+            window = int(a, 0)
         if o == "-u":
             actions.append('upload')
         if o == "-g":
@@ -327,6 +147,20 @@ if __name__ == "__main__":
             sys.exit(0)
         if o == "-f":
             force_overwrite = True
+        if o in ["-v", "--verify"]:
+            verify = True
+        if o == "-c":
+            changedonly = True
+        if o == "-n":
+            usecache = False
+        if o == "--resume":
+            resume = True
+        if o == "-a":
+            alldevices = True
+        if o == "-L":
+            link = a
+        if o == "--stats":
+            statsformat = a
 
     #
     # validate options
@@ -342,11 +176,66 @@ if __name__ == "__main__":
         sys.stderr.write("please choose either upload (-u), retrieve (-g) or list (-l)\n")
         sys.exit(1)
 
+    if not link in ['usb', 'din', 'auto']:
+        sys.stderr.write("please choose usb, din or auto as link (-L)\n")
+        sys.exit(1)
+
+    if statsformat and not statsformat in ['text', 'json']:
+        sys.stderr.write("please choose text or json as statistics format\n")
+        sys.exit(1)
+
     if 'list' in actions:
-        midi_detect(True, True)
+        midi_detect(True, True, False)
         sys.exit(0)
 
 
+    if display:
+        while len(display) < 4: display += ' '
+
+    if statsformat:
+        stats = stats_enable()
+
+    if 'upload' in actions:
+        if infile:
+            try:
+                inf = open(infile, 'rb')
+            except:
+                raise BCFWException("Unable to open %s.\n" % infile)
+        if stats: inf = stats.file(inf, 'read', 'write')
+        data = bytearray(inf.read())
+        inf.close()
+        datadigest = hashlib.sha1(data).hexdigest()
+
+    #
+    # upload to several devices at once
+    #
+    devices = midifile and midifile.split(',') or []
+    if alldevices:
+        devices = midi_detect(False, True)
+        if not devices:
+            raise BCFWException("No Behringer Control found attached\n")
+    if len(devices) > 1 or alldevices:
+        if not 'upload' in actions:
+            raise BCFWException("Multiple devices are supported for upload only\n")
+        # the caches and journals are by device identity
+        idents = midi_probe(devices)
+        cachefor = None
+        if usecache: cachefor = lambda devname: idents.get(devname) and FlashCache(flash_cache_name(devname, idents[devname]))
+        journalfor = lambda devname: journal_open('upload %s %s' % (flash_cache_name(devname, idents.get(devname)), datadigest), resume)
+        results = flash_fleet(devices, data, max(window or 2, 1), verify, changedonly, cachefor, journalfor, link, stats)
+        for devname in devices:
+            sys.stderr.write('%s: %s\n'%(devname, results[devname] or 'ok'))
+            if display and not results[devname]:
+                midif = MidiPort(devname)
+                flash_link(midif, link, lambda msg: None)
+                send_display(midif, display)
+                midif.close()
+        if stats: stats_output(stats, statsformat)
+        failed = len([d for d in devices if results[d]])
+        if failed:
+            raise BCFWException("%d of %d devices failed, run again with --resume to continue" % (failed, len(devices)))
+        sys.exit(0)
+
     #
     # detect midi device when required, and open it
     #
@@ -355,38 +244,73 @@ if __name__ == "__main__":
         if not midifile:
             raise BCFWException("No Behringer Control found attached\n")
 
+    # the cache and journal are by device identity
+    ident = None
+    if 'upload' in actions or 'retrieve' in actions:
+        ident = midi_probe([midifile]).get(midifile)
+        if not ident and usecache:
+            sys.stderr.write("warning: device did not identify itself, not using the flash cache\n")
+
     try:
-        midif = open(midifile, 'r+b', 0)
+        midif = MidiPort(midifile)
     except:
         raise BCFWException("Unable to open midi device %s.\n" % midifile)
+    midif.stats = stats
+    flash_link(midif, link)
+
+    cache = None
+    if usecache and ident: cache = FlashCache(flash_cache_name(midifile, ident))
+    journal = None
 
     #
     # execute action
     #
-    if 'retrieve' in actions:
+    try:
+      if 'retrieve' in actions:
+        if outfile and os.path.exists(outfile) and not force_overwrite:
+            raise BCFWException("Output file %s exists.\n" % outfile)
+        journal = journal_open('retrieve %s 0x%x-0x%x' % (flash_cache_name(midifile, ident), arange[0], arange[1]), resume)
+        data = flash_get(midif, arange[0], arange[1]-arange[0], max(window or 4, 1), cache=cache, journal=journal)
+        # only open the output now, so that an interrupted run leaves no file
         if outfile:
-            if os.path.exists(outfile) and not force_overwrite:
-                raise BCFWException("Output file %s exists.\n" % outfile)
             try:
                 outf = open(outfile, 'w')
             except:
                 raise BCFWException("Unable to open %s.\n" % outfile)
-        data = flash_get(midif, arange[0], arange[1]-arange[0])
+        if stats: outf = stats.file(outf, 'read', 'write')
         outf.write(array2str(data))
         outf.close()
-
-    elif 'upload' in actions:
-        if infile:
-            try:
-                inf = open(infile, 'rb')
-            except:
-                raise BCFWException("Unable to open %s.\n" % infile)
-        data = str2array(inf.read())
-        inf.close()
-        flash_upload(midif, data)
+        journal.finish()
+
+      elif 'upload' in actions:
+        sectors = flash_sectors(data)
+        journal = journal_open('upload %s %s' % (flash_cache_name(midifile, ident), datadigest), resume)
+        if resume:
+            total = len(sectors)
+            sectors = flash_resume(sectors, journal)
+            sys.stderr.write("resuming, %d of %d sectors done already\n" % (total-len(sectors), total))
+        if changedonly:
+            total = len(sectors)
+            sectors = flash_changed(midif, sectors, cache=cache)
+            sys.stderr.write("%d of %d sectors changed\n" % (len(sectors), total))
+        if verify:
+            bad = flash_upload_verify(midif, sectors, max(window or 2, 1), cache=cache, journal=journal)
+            if bad:
+                raise BCFWException("verify failed at " + ", ".join(['0x%06x'%a for a in bad]))
+            sys.stderr.write("verify ok\n")
+        else:
+            written = flash_upload_sectors(midif, sectors, max(window or 2, 1), cache=cache, journal=journal)
+            if flash_unwritten(sectors, written):
+                raise BCFWException("not all sectors were written")
+        journal.finish()
+    finally:
+        # also remember what was done when something went wrong halfway
+        if cache: cache.save()
+        if journal and not journal.finished:
+            sys.stderr.write("\ninterrupted, run again with --resume to continue\n")
+        if stats: stats_output(stats, statsformat)
 
     if display:
-        while len(display) < 4: display += ' '
         send_display(midif, display)
 
   except BCFWException, e:
@@ -27,6 +27,9 @@
 import sys, os, re, tempfile, getopt
 from subprocess import Popen, PIPE
 
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+from bcfw.image import BinaryImage
+
 _usage = r"""
 annotated ARM disassembler
 Usage: %s [-h] [-f] [-i input_file] [-o out_file] file_to_disassemble
@@ -38,18 +41,14 @@ Usage: %s [-h] [-f] [-i input_file] [-o out_file] file_to_disassemble
 """[1:] % (sys.argv[0])
 
 
-def hexdump(filename, offset, count, width):
+_hexformats = { 1: 'B', 2: 'H', 4: 'I' }
+
+def hexdump(image, offset, count, width):
     '''return hexdump of bytes, little endian'''
     b = []
     last = None
-    f = open(filename, 'rb')
-    f.seek(offset)
     dupcount = 0
-    for i in range(count):
-        val = 0
-        for j in range(width):
-            d = ord(f.read(1))
-            val += d << (j*8)
+    for val in image.unpack('<%d%s'%(count, _hexformats[width]), offset):
         if val == last:
             dupcount += 1
             b[-1] = format(last, '0%dx'%(width*2))+'*%d'%dupcount
@@ -57,16 +56,11 @@ def hexdump(filename, offset, count, width):
             last = val
             dupcount = 1
             b.append(format(val, '0%dx'%(width*2)))
-    f.close()
     return ' '.join(b)
 
-def stringdump(filename, offset, count):
-    '''return string from file'''
-    f = open(filename, 'rb')
-    f.seek(offset)
-    s = f.read(count)
-    f.close()
-    return '"'+s+'"'
+def stringdump(image, offset, count):
+    '''return string from image'''
+    return '"'+str(image[offset:offset+count])+'"'
 
 def disassemble(realbin, addr, count, offset, dopts, outbuf, linecomment):
     global objdump
@@ -103,6 +97,7 @@ def parse_da(inf, bin, outf):
 
     offset = 0
     realbin = bin
+    binimage = image = BinaryImage(bin)
     lineno = 2
     dopts = ''
     prevaddr = -1
@@ -158,16 +153,11 @@ def parse_da(inf, bin, outf):
                 # objdump's adjust-vma option needs to be >0, so we create a new
                 # file start starts at a different position for this
                 realbin = bin+'.da2diss.tmp'
-                tmpfile = open(realbin, 'w')
-                orgfile = open(bin, 'rb')
-                orgfile.seek(-offset)
-                length = os.path.getsize(bin) + offset
-                while length:
-                    s = min(1024, length)
-                    tmpfile.write(orgfile.read(s))
-                    length -= s
-                orgfile.close()
+                if image is not binimage: image.close()
+                tmpfile = open(realbin, 'wb')
+                tmpfile.write(binimage[-offset:])
                 tmpfile.close()
+                image = BinaryImage(realbin)
                 offset = 0
             prevaddr = -1
             outbuf.append(fullcmd)
@@ -179,13 +169,13 @@ def parse_da(inf, bin, outf):
             else:
                 count = int(m.group(1), 16)
                 if cmd == '.ascii':
-                    line = stringdump(realbin, addr-offset, count)
+                    line = stringdump(image, addr-offset, count)
                 else:
                     if cmd == '.byte': x=1
                     elif cmd == '.short': x=2
                     elif cmd == '.word': x=4
                     else: pass # unreachable code
-                    line = hexdump(realbin, addr-offset, count, x)
+                    line = hexdump(image, addr-offset, count, x)
                 line = '%8x:\t%s'%(addr, line)
                 if linecomment:
                     line += linecomment
@@ -206,6 +196,8 @@ def parse_da(inf, bin, outf):
     outbuf_flush(outbuf, outf)
 
     # remove tempfile if it was so
+    if image is not binimage: image.close()
+    binimage.close()
     if bin != realbin: os.remove(realbin)
 
 
@@ -0,0 +1,140 @@
+#!/usr/bin/env python
+#
+#  Unofficial Behringer Control Development Kit - standalone script builder
+#
+#  Copyright (C) 2010 Willem van Engen <dev-bc2000@willem.engen.nl>
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License along
+#  with this program; if not, write to the Free Software Foundation, Inc.,
+#  51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+
+#
+# Create a single-file version of one of the tools by pasting the bcfw modules
+# it uses in place of its imports, so that the script can be copied around
+# without caring for dependencies.
+#
+
+import sys, os, re, getopt
+
+_usage = r"""
+standalone script builder
+Usage: %s [-h] [-f] [-o out_file] script
+
+    -o   name of output file (default: standard output)
+    -f   force overwriting of the output file
+    -h   show this help
+"""[1:] % (sys.argv[0])
+
+_bcfwdir = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'bcfw')
+_bcfwimport = re.compile(r'^from bcfw\.(\w+) import ')
+
+def module_code(name):
+    '''return code of a bcfw module without its header, bcfw imports and
+       the code it runs by itself'''
+    lines = open(os.path.join(_bcfwdir, name+'.py')).readlines()
+    # skip license header
+    while lines and lines[0].startswith('#'): lines.pop(0)
+    # and the main block with the comments and blank lines before it
+    for i, l in enumerate(lines):
+        if l.startswith('if __name__ == "__main__":'):
+            del lines[i:]
+            while lines and (not lines[-1].strip() or lines[-1].startswith('#')): lines.pop()
+            lines.append('\n')
+            break
+    return [l for l in lines if not _bcfwimport.match(l)]
+
+def module_deps(lines):
+    '''return names of bcfw modules imported by lines of code'''
+    deps = []
+    for l in lines:
+        m = _bcfwimport.match(l)
+        if m and m.group(1) not in deps: deps.append(m.group(1))
+    return deps
+
+def standalone(lines):
+    '''return script lines with bcfw imports replaced by the modules' code'''
+    # modules in dependency order
+    order = []
+    def visit(name):
+        if name in order: return
+        for dep in module_deps(open(os.path.join(_bcfwdir, name+'.py'))):
+            visit(dep)
+        order.append(name)
+    for name in module_deps(lines): visit(name)
+    out = []
+    for l in lines:
+        # setting up the path to find the package is not needed anymore
+        if l.startswith('sys.path.insert') and 'pardir' in l:
+            continue
+        if not _bcfwimport.match(l):
+            out.append(l)
+        # paste all modules at the first bcfw import
+        elif order:
+            out.append('# code below was pasted from the bcfw package by mkstandalone.py\n')
+            for name in order:
+                out.append('\n## bcfw.%s\n'%name)
+                out += module_code(name)
+            out.append('\n')
+            order = []
+    return out
+
+
+##############################################################################
+## Main program
+
+if __name__ == "__main__":
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], "o:hf")
+    except getopt.GetoptError:
+        sys.stderr.write(_usage)
+        sys.exit(1)
+
+    outf            = sys.stdout
+    outfile         = None
+    force_overwrite = False
+
+    for o, a in opts:
+        if o == "-o":
+            outfile = a
+        if o == "-h":
+            sys.stderr.write(_usage)
+            sys.exit(0)
+        if o == "-f":
+            force_overwrite = True
+
+    if len(args) != 1:
+        sys.stderr.write(_usage)
+        sys.exit(1)
+
+    try:
+        lines = open(args[0]).readlines()
+    except:
+        sys.stderr.write("Unable to open %s.\n" % args[0])
+        sys.exit(1)
+
+    if outfile:
+        if os.path.exists(outfile) and not force_overwrite:
+            sys.stderr.write("Output file %s exists.\n" % outfile)
+            sys.exit(1)
+        try:
+            outf = open(outfile, 'w')
+        except:
+            sys.stderr.write("Unable to open %s.\n" % outfile)
+            sys.exit(1)
+
+    outf.writelines(standalone(lines))
+    outf.close()
+    if outfile: os.chmod(outfile, 0755)
+
+# vim:et:sw=4:ts=4:ai: